@@ -0,0 +1,168 @@
+import asyncio
+import socket
+import traceback
+
+import common
+import handshake
+import wildcat_receiver
+import wildcat_sender
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+def new_event_loop():
+    ''' uvloop when it is installed, the stock asyncio loop otherwise '''
+    if uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+class async_timer_scheduler:
+    ''' same interface as common.timer_scheduler, but timers are loop.call_later handles
+    firing callback(key) on the event loop thread instead of being collected by a run() loop '''
+    def __init__(self, loop, callback=None):
+        self.loop = loop
+        self.callback = callback
+        self.handles = {}
+
+    def now(self):
+        return self.loop.time()
+
+    def arm(self, key, delay):
+        self.cancel(key)
+        self.handles[key] = self.loop.call_later(delay, self.expire, key)
+
+    def cancel(self, key):
+        handle = self.handles.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+
+    def is_armed(self, key) -> bool:
+        return key in self.handles
+
+    def expire(self, key):
+        del self.handles[key]
+        self.callback(key)
+
+    def stop(self):
+        for handle in self.handles.values():
+            handle.cancel()
+        self.handles = {}
+
+
+class wildcat_protocol(asyncio.DatagramProtocol):
+    ''' asyncio replacement for UDP_sender / UDP_receiver: datagrams go straight from the
+    transport into the tunnel and the tunnel sends straight to the transport, no queue or thread.
+    After a handshake the receiver's responder answers retransmits that trail in, the sender drops
+    the late answers (they would read as an ACK) '''
+    def __init__(self, my_tunnel, peer_addr=None, session=None, responder=None):
+        self.my_tunnel = my_tunnel
+        # a sender knows its peer up front, a receiver answers whoever sent last
+        self.fixed_peer = peer_addr is not None
+        self.peer_addr = peer_addr
+        self.transport = None
+        self.nonce = session.nonce if session is not None and self.fixed_peer else None
+        self.responder = responder
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.my_tunnel.my_send = self.send
+
+    def datagram_received(self, data, addr):
+        if self.nonce is not None and handshake.is_session_message(data, self.nonce):
+            return
+        if self.responder is not None:
+            reply = self.responder.answer(data)
+            if reply is not None:
+                self.transport.sendto(reply, addr)
+                return
+        if not self.fixed_peer:
+            self.peer_addr = addr
+        try:
+            self.my_tunnel.magic_recv(data)
+        except Exception:
+            traceback.print_exc()
+
+    def error_received(self, exc):
+        print(f"UDP error : {exc}")
+
+    def send(self, packet_byte_array):
+        if self.peer_addr is not None:
+            self.transport.sendto(packet_byte_array, self.peer_addr)
+
+
+class async_endpoint:
+    ''' one wildcat_sender / wildcat_receiver bound to its own UDP transport, many of these can share a loop.
+    session holds what the handshake agreed on, None without one '''
+    def __init__(self, wildcat, transport, my_tunnel, my_logger, session=None):
+        self.wildcat = wildcat
+        self.transport = transport
+        self.my_tunnel = my_tunnel
+        self.my_logger = my_logger
+        self.session = session
+
+    def close(self):
+        self.wildcat.timers.stop()
+        self.transport.close()
+        self.my_tunnel.close()
+        self.my_logger.close()
+
+
+async def create_sender(ip, port, allowed_loss, window_size, loss_rate, corrupt_rate, my_logger=None, negotiate=False,
+                        max_datagram_size=handshake.PROBE_SIZES[0], **sender_options) -> async_endpoint:
+    ''' with negotiate the handshake with the receiver (see handshake.py) decides window size,
+    datagram size and features first, it runs in the loop's executor '''
+    loop = asyncio.get_running_loop()
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.bind(('0.0.0.0', 0))
+    session = None
+    if negotiate:
+        session = await loop.run_in_executor(None, handshake.connect, udp_socket, (ip, port), window_size,
+                                             handshake.features_of(sender_options), max_datagram_size)
+    if session is not None:
+        window_size = session.window_size
+        sender_options.update(session.sender_options())
+    my_tunnel = common.magic_tunnel(loss_rate, corrupt_rate)
+    my_logger = my_logger if my_logger is not None else common.logger()
+    timers = async_timer_scheduler(loop)
+    my_wildcat_sender = wildcat_sender.wildcat_sender(allowed_loss, window_size, my_tunnel, my_logger, timers, **sender_options)
+    timers.callback = my_wildcat_sender.timeout_callback
+    my_tunnel.my_recv = my_wildcat_sender.receive
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: wildcat_protocol(my_tunnel, (ip, port), session), sock=udp_socket)
+    return async_endpoint(my_wildcat_sender, transport, my_tunnel, my_logger, session)
+
+
+async def create_receiver(port, allowed_loss, window_size, loss_rate, corrupt_rate, my_logger=None, negotiate=False,
+                          max_datagram_size=common.MAX_UDP_PAYLOAD, **receiver_options) -> async_endpoint:
+    ''' with negotiate this waits for the first sender's handshake (see handshake.py), a sender
+    without one goes with the settings passed here '''
+    loop = asyncio.get_running_loop()
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.bind(('0.0.0.0', port))
+    udp_socket.setblocking(False)
+    session = responder = None
+    if negotiate:
+        responder = handshake.handshake_responder(window_size, max_datagram_size)
+        try:
+            session = await handshake.accept_async(udp_socket, responder)
+        except BaseException:
+            udp_socket.close()
+            raise
+    if session is not None:
+        window_size = session.window_size
+        receiver_options.update(session.receiver_options())
+    else:
+        responder = None
+    my_tunnel = common.magic_tunnel(loss_rate, corrupt_rate)
+    my_logger = my_logger if my_logger is not None else common.logger()
+    timers = async_timer_scheduler(loop)
+    my_wildcat_receiver = wildcat_receiver.wildcat_receiver(allowed_loss, window_size, my_tunnel, my_logger, timers, **receiver_options)
+    timers.callback = my_wildcat_receiver.timeout_callback
+    my_tunnel.my_recv = my_wildcat_receiver.receive
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: wildcat_protocol(my_tunnel, responder=responder), sock=udp_socket)
+    return async_endpoint(my_wildcat_receiver, transport, my_tunnel, my_logger, session)
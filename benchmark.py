@@ -0,0 +1,181 @@
+''' Throughput / latency benchmark for the wildcat protocol over loopback UDP.
+Sweeps payload size x packet count x window size x loss rate x corrupt rate and writes one
+JSON record per combination. Usage:
+    python benchmark.py [--payload-sizes=64,1024] [--counts=2000] [--windows=20,200]
+                        [--loss-rates=0,5] [--corrupt-rates=0] [--repeat=1] [--timeout=60]
+                        [--output=bench.json] [--compare=old_bench.json]
+                        [--cc=newreno|cubic] [--pacing] [--ack-every=N]
+'''
+
+import sys
+import os
+import json
+import time
+import struct
+import itertools
+import subprocess
+import platform
+
+import common
+import start_receiver
+import start_sender
+import wildcat_receiver
+import wildcat_sender
+
+
+class timing_logger(common.logger):
+    ''' logger that also remembers when each payload was committed '''
+    def __init__(self, my_log_file):
+        super(timing_logger, self).__init__(my_log_file, log_format="binary")
+        self.commit_times = []
+
+    def commit(self, packet, prefix=b""):
+        self.commit_times.append(time.perf_counter())
+        super().commit(packet, prefix)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_once(payload_size, count, window_size, loss_rate, corrupt_rate, timeout, sender_options, receiver_options):
+    payload_size = max(4, payload_size) # room for the packet index used to match latencies
+    filler = bytes(payload_size - 4)
+
+    receiver_logger = timing_logger("log/benchmark_receiver")
+    receiver_tunnel = common.magic_tunnel(loss_rate, corrupt_rate)
+    my_receiver = wildcat_receiver.wildcat_receiver(0, window_size, receiver_tunnel, receiver_logger, **receiver_options)
+    receiver_tunnel.my_recv = my_receiver.receive
+    # port 0: let the kernel pick, no collisions between runs or with anything else on the box
+    udp_receiver = start_receiver.UDP_receiver(0, receiver_tunnel)
+    port = udp_receiver.udp_socket.getsockname()[1]
+
+    sender_logger = common.logger("log/benchmark_sender")
+    sender_tunnel = common.magic_tunnel(loss_rate, corrupt_rate)
+    my_sender = wildcat_sender.wildcat_sender(0, window_size, sender_tunnel, sender_logger, **sender_options)
+    sender_tunnel.my_recv = my_sender.receive
+    udp_sender = start_sender.UDP_sender("localhost", port, sender_tunnel)
+
+    for thread in (my_receiver, udp_receiver, my_sender, udp_sender):
+        thread.start()
+
+    send_times = [0.0] * count
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    deadline = start + timeout
+    queued = True
+    for i in range(count):
+        send_times[i] = time.perf_counter()
+        # a stalled link keeps the backlog full, don't let backpressure outlast the time budget
+        if not my_sender.new_packet(struct.pack("!I", i) + filler, timeout=max(0, deadline - send_times[i])):
+            queued = False
+            break
+    completed = queued and receiver_logger.wait_for_commits(count, max(0, deadline - time.perf_counter()))
+    elapsed = time.perf_counter() - start
+    cpu_time = time.process_time() - cpu_start
+
+    udp_sender.join()
+    udp_receiver.join()
+    my_sender.join()
+    my_receiver.join()
+    sender_logger.close()
+    sender_tunnel.close()
+    receiver_tunnel.close()
+
+    commit_list = receiver_logger.get_commit_list()
+    latencies = sorted(commit_time - send_times[struct.unpack("!I", payload[:4])[0]]
+                       for payload, commit_time in zip(commit_list, receiver_logger.commit_times))
+    delivered = len(commit_list)
+    return {
+        "completed": completed,
+        "delivered": delivered,
+        "elapsed_s": elapsed,
+        "goodput_mbps": delivered * payload_size * 8 / elapsed / 1e6,
+        "packets_per_s": delivered / elapsed,
+        "latency_p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+        "latency_p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+        "retransmission_ratio": my_sender.metrics.get("retransmitted") / max(1, my_sender.metrics.get("sent")),
+        "cpu_time_s": cpu_time,
+        "cpu_per_packet_us": cpu_time / max(1, delivered) * 1e6,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def int_list(value):
+    return [int(v) for v in str(value).split(",")]
+
+
+def compare(results, baseline_file):
+    ''' prints goodput / p99 changes against an earlier run for every parameter combination both have '''
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    params = ("payload_size", "count", "window_size", "loss_rate", "corrupt_rate")
+    old = {tuple(r[p] for p in params): r for r in baseline["results"]}
+    print(f"compared to {baseline_file} ({baseline.get('revision')})")
+    for r in results:
+        key = tuple(r[p] for p in params)
+        if key not in old:
+            continue
+        before = old[key]
+        change = (r["goodput_mbps"] / before["goodput_mbps"] - 1) * 100 if before["goodput_mbps"] else float("nan")
+        print(f"  {dict(zip(params, key))}: goodput {before['goodput_mbps']:.2f} -> {r['goodput_mbps']:.2f} Mbit/s ({change:+.1f}%), "
+              f"p99 {before['latency_p99_ms']} -> {r['latency_p99_ms']} ms")
+
+
+if __name__ == '__main__':
+    _, options = common.split_args(sys.argv)
+    payload_sizes = int_list(options.get("payload-sizes", "64,1024"))
+    counts = int_list(options.get("counts", "2000"))
+    windows = int_list(options.get("windows", "20,200"))
+    loss_rates = int_list(options.get("loss-rates", "0,5"))
+    corrupt_rates = int_list(options.get("corrupt-rates", "0"))
+    repeat = int(options.get("repeat", 1))
+    timeout = float(options.get("timeout", 60))
+    output = options.get("output", "bench.json")
+
+    sender_options = {}
+    if "cc" in options:
+        sender_options["congestion_control"] = options["cc"]
+    if "pacing" in options:
+        sender_options["pacing"] = True
+    receiver_options = {}
+    if "ack-every" in options:
+        receiver_options["ack_every"] = int(options["ack-every"])
+
+    os.makedirs("log", exist_ok=True)
+    results = []
+    for payload_size, count, window_size, loss_rate, corrupt_rate in itertools.product(payload_sizes, counts, windows, loss_rates, corrupt_rates):
+        for run in range(repeat):
+            result = run_once(payload_size, count, window_size, loss_rate, corrupt_rate, timeout, sender_options, receiver_options)
+            result.update({"payload_size": payload_size, "count": count, "window_size": window_size,
+                           "loss_rate": loss_rate, "corrupt_rate": corrupt_rate, "run": run})
+            results.append(result)
+            print(f"payload={payload_size} count={count} window={window_size} loss={loss_rate} corrupt={corrupt_rate}: "
+                  f"{result['goodput_mbps']:.2f} Mbit/s, {result['packets_per_s']:.0f} pkt/s, "
+                  f"p50={result['latency_p50_ms'] or 0:.1f} ms, p99={result['latency_p99_ms'] or 0:.1f} ms, "
+                  f"retx={result['retransmission_ratio']:.3f}, cpu={result['cpu_time_s']:.2f} s"
+                  + ("" if result["completed"] else f" (INCOMPLETE {result['delivered']}/{count})"))
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sender_options": sender_options,
+        "receiver_options": receiver_options,
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {output}")
+
+    if "compare" in options:
+        compare(results, options["compare"])
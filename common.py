@@ -1,20 +1,53 @@
+import collections
+import heapq
+import os
 import queue
 import random
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
 
 log_file = "log.txt"
 
+# Linux UDP segmentation offload: one sendmsg() / recvmsg() carries many equal sized datagrams
+SOL_UDP = 17
+UDP_SEGMENT = 103
+UDP_GRO = 104
+# largest UDP payload over IPv4, the receive buffer size unless a handshake agreed on less
+MAX_UDP_PAYLOAD = 65507
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65000
+GSO_SIZE = struct.Struct("=H")
+GRO_SIZE = struct.Struct("=i")
+
 class magic_tunnel:
     my_recv = None
+    # when set (asyncio mode) packets are handed straight to the transport instead of send_queue
+    my_send = None
 
-    def __init__(self, loss_rate, corrupt_rate):
+    def __init__(self, loss_rate, corrupt_rate, seed=None):
         self.loss_rate = loss_rate
         self.corrupt_rate = corrupt_rate
-        self.send_queue = queue.Queue()
+        # own generator so runs can be reproduced with a seed and tunnels don't share draws
+        self.random = random.Random(seed)
+        self.send_queue = collections.deque()
         self.recv_queue = queue.Queue()
+        # the UDP loop sleeps in select() on this pipe, magic_send() pokes it when there is work
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.wakeup_pending = False
+        self.closed = False
+        self.send_lost = 0
+        self.recv_lost = 0
     
     def do_magic(self, packet_byte_array):
-        loss = random.randint(0,100)
-        corrupt = random.randint(0,100)
+        loss = self.random.randint(0,100)
+        corrupt = self.random.randint(0,100)
         if loss < self.loss_rate:
             # packet got lost
             return None
@@ -22,7 +55,9 @@ class magic_tunnel:
             # packet got corrupted
             # print("Before corrupt: ")
             # print_bits(packet_byte_array)
-            bit_to_flip = random.randint(0, len(packet_byte_array) * 8 - 1)
+            # corrupt a copy, the caller may keep the original around for retransmission
+            packet_byte_array = bytearray(packet_byte_array)
+            bit_to_flip = self.random.randint(0, len(packet_byte_array) * 8 - 1)
             byte_to_be_flipped = packet_byte_array[int(bit_to_flip / 8)]
             flipped_byte = byte_to_be_flipped ^ (1 << (bit_to_flip % 8))
             packet_byte_array[int(bit_to_flip / 8)] = flipped_byte
@@ -33,10 +68,15 @@ class magic_tunnel:
     def magic_send(self, packet_byte_array):
         pkt_to_send = self.do_magic(packet_byte_array)
         if pkt_to_send == None:
-            print("Send lost")
+            self.send_lost += 1
             return
+        elif self.my_send != None:
+            self.my_send(pkt_to_send)
         else:
-            self.send_queue.put(pkt_to_send)
+            self.send_queue.append(pkt_to_send)
+            if not self.wakeup_pending:
+                self.wakeup_pending = True
+                self.wake()
 
     def magic_recv(self, packet_byte_array):
         if self.my_recv == None:
@@ -44,7 +84,7 @@ class magic_tunnel:
         else:
             pkt_to_receive = self.do_magic(packet_byte_array)
             if pkt_to_receive == None:
-                print("Receive lost")
+                self.recv_lost += 1
                 return
             else:
                 self.my_recv(pkt_to_receive)
@@ -53,11 +93,288 @@ class magic_tunnel:
     def get_packet(self):
         ret_pkt = None
         try:
-            ret_pkt = self.send_queue.get_nowait()
-        except queue.Empty:
+            ret_pkt = self.send_queue.popleft()
+        except IndexError:
             ret_pkt = None
         return ret_pkt
 
+    def unget_packet(self, packet_byte_array):
+        # socket buffer was full, put it back at the head so ordering is kept
+        self.send_queue.appendleft(packet_byte_array)
+
+    def has_packets(self) -> bool:
+        return len(self.send_queue) > 0
+
+    def wake(self):
+        if self.closed:
+            return # a late send after shutdown, the fd number may already belong to someone else
+        try:
+            os.write(self.wakeup_w, b"\0")
+        except BlockingIOError:
+            pass # pipe already full of wakeups, the loop will notice
+
+    def clear_wakeup(self):
+        # drain first, then clear the flag: a concurrent magic_send() either appended before
+        # the flag was cleared (the caller flushes the queue next) or sees it cleared and
+        # writes a new byte that this drain can no longer swallow
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        self.wakeup_pending = False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+def enable_gro(udp_socket) -> bool:
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        udp_socket.setsockopt(SOL_UDP, UDP_GRO, 1)
+    except OSError:
+        return False # kernel older than 5.0
+    return True
+
+class udp_endpoint(threading.Thread):
+    ''' event driven UDP I/O loop shared by UDP_sender and UDP_receiver.
+    Sleeps in the selector until a datagram arrives or the tunnel has packets queued,
+    the socket is only registered for writability while a send would block.
+    Packets go to send_addr, a receiver leaves it None and learns it from the first datagram.
+    Every wakeup drains the send queue and up to batch_size reads. With offload (Linux only)
+    runs of equal sized packets go out as one UDP_SEGMENT (GSO) send and the kernel may hand
+    back many datagrams in one UDP_GRO read; without kernel support it is one syscall per datagram '''
+    def __init__(self, my_tunnel, udp_socket, send_addr=None, batch_size=64, offload=True, max_datagram_size=MAX_UDP_PAYLOAD):
+        super(udp_endpoint, self).__init__()
+        self.my_tunnel = my_tunnel
+        self.udp_socket = udp_socket
+        self.send_addr = send_addr
+        self.udp_socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.udp_socket, selectors.EVENT_READ)
+        self.selector.register(self.my_tunnel.wakeup_r, selectors.EVENT_READ)
+        self.want_write = False
+        self.die = False
+        self.batch_size = batch_size
+        # GSO support only shows on the first send, a failed one turns it off
+        self.gso = offload and sys.platform.startswith("linux")
+        self.gro = offload and enable_gro(udp_socket)
+        # datagrams are read into this one buffer and handled before the next read, so it is the
+        # whole buffer pool: whoever keeps a packet past on_datagram (out of order payloads) copies it
+        self.set_max_datagram_size(max_datagram_size)
+
+    def set_max_datagram_size(self, max_datagram_size):
+        ''' sizes the receive buffer, before start(). A GRO read can hold up to 64 KB whatever the datagram size '''
+        self.recv_buffer = bytearray(65536 if self.gro else max_datagram_size)
+        self.recv_view = memoryview(self.recv_buffer)
+
+    def get_send_addr(self):
+        return self.send_addr
+
+    def on_datagram(self, udp_data, addr):
+        self.my_tunnel.magic_recv(udp_data)
+
+    def run(self):
+        while not self.die:
+            try:
+                for key, mask in self.selector.select():
+                    if key.fileobj is self.udp_socket:
+                        if mask & selectors.EVENT_READ:
+                            self.read_socket()
+                        if mask & selectors.EVENT_WRITE:
+                            self.flush_send_queue()
+                    else:
+                        self.my_tunnel.clear_wakeup()
+                        self.flush_send_queue()
+            except Exception as e:
+                traceback.print_exc()
+        self.selector.close()
+        self.udp_socket.close()
+
+    def read_socket(self):
+        for _ in range(self.batch_size):
+            try:
+                if self.gro:
+                    nbytes, ancdata, flags, addr = self.udp_socket.recvmsg_into([self.recv_buffer], socket.CMSG_SPACE(GRO_SIZE.size))
+                else:
+                    nbytes, addr = self.udp_socket.recvfrom_into(self.recv_buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            segment_size = nbytes
+            if self.gro:
+                for level, kind, data in ancdata:
+                    if level == SOL_UDP and kind == UDP_GRO:
+                        segment_size = GRO_SIZE.unpack_from(data)[0]
+            # a GRO read holds several datagrams, all segment_size long but the last
+            for offset in range(0, max(nbytes, 1), max(segment_size, 1)):
+                self.on_datagram(self.recv_view[offset:min(nbytes, offset + segment_size)], addr)
+
+    def next_datagram(self):
+        ''' (packet, address) of the next queued packet, None once the queue is empty '''
+        next_pkt = self.my_tunnel.get_packet()
+        if next_pkt == None:
+            return None
+        return next_pkt, self.get_send_addr()
+
+    def unget_datagram(self, datagram):
+        self.my_tunnel.unget_packet(datagram[0])
+
+    def next_batch(self) -> list:
+        ''' the next queued datagrams that can go out as one GSO send: same address and size,
+        only the last one may be shorter '''
+        first = self.next_datagram()
+        if first is None:
+            return []
+        batch = [first]
+        size = total = len(first[0])
+        while self.gso and len(batch) < GSO_MAX_SEGMENTS:
+            datagram = self.next_datagram()
+            if datagram is None:
+                break
+            if datagram[1] != first[1] or len(datagram[0]) > size or total + len(datagram[0]) > GSO_MAX_BYTES:
+                self.unget_datagram(datagram)
+                break
+            batch.append(datagram)
+            total += len(datagram[0])
+            if len(datagram[0]) < size:
+                break
+        return batch
+
+    def send_batch(self, packets, addr) -> int:
+        ''' returns how many of packets went out before the socket buffer filled up '''
+        if len(packets) > 1 and self.gso:
+            try:
+                self.udp_socket.sendmsg(packets, [(SOL_UDP, UDP_SEGMENT, GSO_SIZE.pack(len(packets[0])))], 0, addr)
+                return len(packets)
+            except BlockingIOError:
+                return 0
+            except OSError:
+                self.gso = False # no segmentation offload on this kernel or route, one by one from now on
+        for sent, packet in enumerate(packets):
+            try:
+                self.udp_socket.sendto(packet, addr)
+            except BlockingIOError:
+                return sent
+        return len(packets)
+
+    def flush_send_queue(self):
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                break
+            send_addr = batch[0][1]
+            if send_addr is None:
+                continue # no peer yet, nobody to send to
+            sent = self.send_batch([datagram[0] for datagram in batch], send_addr)
+            if sent < len(batch):
+                for datagram in reversed(batch[sent:]):
+                    self.unget_datagram(datagram)
+                self.set_want_write(True)
+                return
+        self.set_want_write(False)
+
+    def set_want_write(self, want_write):
+        if want_write != self.want_write:
+            self.want_write = want_write
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+            self.selector.modify(self.udp_socket, events)
+
+    def join(self):
+        self.die = True
+        self.my_tunnel.wake()
+        super().join()
+
+class timer_scheduler:
+    ''' single retransmission scheduler for one endpoint, driven by that endpoint's run() loop.
+    Timers are keyed (e.g. by seq num), arming is O(log n), cancelling is O(1) (lazy delete)
+    and expiring is O(log n), so the thread count stays constant regardless of window size '''
+    def __init__(self):
+        self.heap = []
+        self.timers = {}
+        self.counter = 0
+        self.cancelled = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+
+    def now(self):
+        return time.monotonic()
+
+    def arm(self, key, delay):
+        with self.cond:
+            self.discard(key)
+            entry = [self.now() + delay, self.counter, key, True]
+            self.counter += 1
+            self.timers[key] = entry
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                # new earliest deadline, wake the run() loop so it can shorten its wait
+                self.cond.notify()
+
+    def cancel(self, key):
+        with self.cond:
+            self.discard(key)
+
+    def is_armed(self, key) -> bool:
+        return key in self.timers
+
+    def discard(self, key):
+        entry = self.timers.pop(key, None)
+        if entry is not None:
+            entry[3] = False
+            self.cancelled += 1
+            # compact once dead entries dominate the heap, keeps memory proportional to live timers
+            if self.cancelled > 64 and self.cancelled * 2 > len(self.heap):
+                self.heap = [e for e in self.heap if e[3]]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def pop_expired(self) -> list:
+        expired = []
+        now = self.now()
+        while self.heap and (not self.heap[0][3] or self.heap[0][0] <= now):
+            entry = heapq.heappop(self.heap)
+            if not entry[3]:
+                self.cancelled -= 1
+                continue
+            entry[3] = False
+            del self.timers[entry[2]]
+            expired.append(entry[2])
+        return expired
+
+    def wait_expired(self) -> list:
+        ''' blocks until at least one timer expires (or stop() is called), returns the expired keys '''
+        with self.cond:
+            while not self.stopped:
+                expired = self.pop_expired()
+                if expired:
+                    return expired
+                if self.heap:
+                    self.cond.wait(self.heap[0][0] - self.now())
+                else:
+                    self.cond.wait()
+            return []
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+def split_args(argv):
+    ''' splits argv into the positional arguments and --option / --option=value flags '''
+    positional = []
+    options = {}
+    for arg in argv:
+        if arg.startswith("--"):
+            name, _, value = arg[2:].partition("=")
+            options[name] = value if value != "" else True
+        else:
+            positional.append(arg)
+    return positional, options
+
 def print_bits(byte_array):
     print_str = ""
     for b in byte_array:
@@ -65,17 +382,120 @@ def print_bits(byte_array):
     print(print_str)
 
 class logger:
+    ''' commit sink: O(1) in-memory append plus a session-long file handle.
+    Records are group flushed by a background writer once flush_bytes are pending or
+    flush_interval seconds passed, so commit() never waits on disk I/O.
+    log_format "text" writes one repr() per line, "binary" writes 4B length prefixed payloads
+    (read back with read_commit_log). fsync_policy is "never", "flush" (after every group flush)
+    or "close". keep_commits=False only counts commits instead of keeping them in commit_list,
+    for long running receivers. get_free_space() reports how much of max_pending is left, the
+    receiver advertises it as its window so a slow disk throttles the sender '''
     commit_list = []
-    def __init__(self, my_log_file=log_file):
+    def __init__(self, my_log_file=log_file, log_format="text", flush_bytes=64 * 1024, flush_interval=0.2, fsync_policy="never",
+                 keep_commits=True, max_pending=16 * 1024 * 1024):
+        if log_format not in ("text", "binary"):
+            raise Exception(f"Unknown log format : {log_format}")
+        if fsync_policy not in ("never", "flush", "close"):
+            raise Exception(f"Unknown fsync policy : {fsync_policy}")
         self.my_log_file = my_log_file
-        open(self.my_log_file, 'w+').close()
+        self.log_format = log_format
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
         self.commit_list = []
+        self.keep_commits = keep_commits
+        self.commit_count = 0
+        self.max_pending = max_pending
+
+        self.log_file_handle = open(self.my_log_file, 'wb')
+        self.pending = bytearray()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # same lock as cond, but only wait_for_commits() sleeps on it so commits never wake the writer early
+        self.committed = threading.Condition(self.lock)
+        # held while writing so group flushes from the writer and flush() land in commit order
+        self.io_lock = threading.Lock()
+        self.writer = None
+        self.closed = False
+
+    def commit(self, packet, prefix=b""):
+        ''' packet may be a view into a receive buffer that is reused once this returns, it is copied
+        here: straight into the pending records in binary format. prefix is logged in front of it '''
+        if self.keep_commits or self.log_format == "text":
+            packet = prefix + packet if prefix else bytearray(packet) if isinstance(packet, memoryview) else packet
+            prefix = b""
+        if self.keep_commits:
+            self.commit_list.append(packet)
+        with self.cond:
+            if self.writer is None:
+                # started lazily, a sender side logger never commits and never needs one
+                self.writer = threading.Thread(target=self.write_loop, daemon=True)
+                self.writer.start()
+            if self.log_format == "binary":
+                self.pending += struct.pack("!I", len(prefix) + len(packet))
+                self.pending += prefix
+                self.pending += packet
+            else:
+                self.pending += (packet.__repr__() + "\n").encode()
+            self.commit_count += 1
+            if len(self.pending) >= self.flush_bytes:
+                self.cond.notify()
+            self.committed.notify_all()
+
+    def get_free_space(self) -> int:
+        ''' bytes that can still be committed before the writer falls max_pending behind '''
+        with self.cond:
+            return max(0, self.max_pending - len(self.pending))
+
+    def wait_for_commits(self, count, timeout=None) -> bool:
+        ''' blocks until at least count payloads were committed, False if timeout ran out first '''
+        with self.committed:
+            return self.committed.wait_for(lambda: self.commit_count >= count, timeout)
 
-    def commit(self, packet):
-        self.commit_list = self.commit_list + [packet]
-        with open(self.my_log_file, 'a') as f:
-            f.write(packet.__repr__())
-            f.write("\n")
+    def write_loop(self):
+        while True:
+            with self.cond:
+                if not self.closed and len(self.pending) < self.flush_bytes:
+                    self.cond.wait(self.flush_interval)
+                if self.closed:
+                    return # close() writes out what is left
+            self.flush()
+
+    def flush(self):
+        with self.io_lock:
+            with self.cond:
+                chunk = self.pending
+                self.pending = bytearray()
+            if len(chunk) == 0 or self.log_file_handle.closed:
+                return
+            self.log_file_handle.write(chunk)
+            self.log_file_handle.flush()
+            if self.fsync_policy == "flush":
+                os.fsync(self.log_file_handle.fileno())
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        if self.writer is not None:
+            self.writer.join()
+        self.flush()
+        with self.io_lock:
+            if self.fsync_policy != "never":
+                os.fsync(self.log_file_handle.fileno())
+            self.log_file_handle.close()
     
     def get_commit_list(self):
-        return self.commit_list
\ No newline at end of file
+        return self.commit_list
+
+def read_commit_log(my_log_file=log_file):
+    ''' yields the payloads of a binary format commit log in commit order '''
+    with open(my_log_file, 'rb') as f:
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return
+            length = struct.unpack("!I", header)[0]
+            yield f.read(length)
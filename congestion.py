@@ -0,0 +1,126 @@
+import math
+
+
+class newreno_controller:
+    ''' AIMD: slow start up to ssthresh, then +1 packet per RTT, halve on loss '''
+    def __init__(self, initial_cwnd=10, min_cwnd=2):
+        self.cwnd = float(initial_cwnd)
+        self.min_cwnd = min_cwnd
+        self.ssthresh = math.inf
+        # losses detected before this time belong to the episode we already reacted to
+        self.recovery_end = 0
+
+    def get_cwnd(self) -> int:
+        return max(self.min_cwnd, int(self.cwnd))
+
+    def on_ack(self, acked, now, srtt):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.cwnd += acked / self.cwnd
+
+    def on_loss(self, now, srtt):
+        if now < self.recovery_end:
+            return
+        self.recovery_end = now + (srtt or 0)
+        self.ssthresh = max(self.cwnd / 2, self.min_cwnd)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, now, srtt):
+        self.ssthresh = max(self.cwnd / 2, self.min_cwnd)
+        self.cwnd = self.min_cwnd
+        self.recovery_end = now + (srtt or 0)
+
+
+class cubic_controller:
+    ''' CUBIC (RFC 8312): window grows along a cubic centred on the size at the last loss,
+    never slower than the equivalent AIMD flow '''
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, initial_cwnd=10, min_cwnd=2):
+        self.cwnd = float(initial_cwnd)
+        self.min_cwnd = min_cwnd
+        self.ssthresh = math.inf
+        self.w_max = 0
+        self.k = 0
+        self.epoch_start = None
+        self.recovery_end = 0
+
+    def get_cwnd(self) -> int:
+        return max(self.min_cwnd, int(self.cwnd))
+
+    def on_ack(self, acked, now, srtt):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+            return
+        if self.epoch_start is None:
+            self.epoch_start = now
+            if self.cwnd < self.w_max:
+                self.k = ((self.w_max - self.cwnd) / self.C) ** (1 / 3)
+            else:
+                self.k = 0
+                self.w_max = self.cwnd
+        t = now - self.epoch_start
+        target = self.C * (t - self.k) ** 3 + self.w_max
+        if srtt:
+            # TCP friendly region: what AIMD with the same beta would have reached by now
+            aimd = self.w_max * self.BETA + 3 * (1 - self.BETA) / (1 + self.BETA) * (t / srtt)
+            target = max(target, aimd)
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * acked
+        else:
+            self.cwnd += 0.01 * acked / self.cwnd
+
+    def on_loss(self, now, srtt):
+        if now < self.recovery_end:
+            return
+        self.recovery_end = now + (srtt or 0)
+        self.w_max = self.cwnd
+        self.cwnd = max(self.cwnd * self.BETA, self.min_cwnd)
+        self.ssthresh = self.cwnd
+        self.epoch_start = None
+
+    def on_timeout(self, now, srtt):
+        self.w_max = self.cwnd
+        self.ssthresh = max(self.cwnd * self.BETA, self.min_cwnd)
+        self.cwnd = self.min_cwnd
+        self.epoch_start = None
+        self.recovery_end = now + (srtt or 0)
+
+
+class token_bucket:
+    ''' pacing: rate tokens (packets) per second, at most burst of them saved up '''
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def set_rate(self, rate):
+        self.rate = rate
+
+    def consume(self, now) -> float:
+        ''' takes a token and returns 0 if one is available, otherwise how long to wait for one '''
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        # refills don't sum to exactly 1.0, without the slack a wait of ~1e-19 s would leave
+        # now unchanged and the pace timer would refire at the same instant forever
+        if self.tokens >= 1 - 1e-6:
+            self.tokens = max(0, self.tokens - 1)
+            return 0
+        return max(1e-4, (1 - self.tokens) / self.rate)
+
+
+controllers = {
+    "newreno": newreno_controller,
+    "cubic": cubic_controller,
+}
+
+def make_controller(congestion):
+    ''' accepts None (fixed window only), a controller name or a controller instance '''
+    if congestion is None or not isinstance(congestion, str):
+        return congestion
+    if congestion not in controllers:
+        raise Exception(f"Unknown congestion controller : {congestion}")
+    return controllers[congestion]()
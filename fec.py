@@ -0,0 +1,155 @@
+''' Forward error correction for wildcat data packets.
+The sender side fec_encoder stands in for the tunnel: every outgoing packet gets a trailer with
+its block number and index, and each block of k packets is followed by one XOR parity repair
+packet. The receiver side fec_decoder rebuilds a single missing packet of a block from the others
+and the parity, so one loss per block costs no retransmission round trip. Both ends have to
+enable it (fec=True on wildcat_sender and wildcat_receiver, --fec on the command line).
+
+On the wire a packet stays a valid wildcat packet (seq num first, checksum last):
+
+    data   : wildcat packet | 2B block | 1B index | 1B DATA   | 2B checksum
+    repair : XOR parity     | 2B block | 1B count | 1B REPAIR | 2B checksum
+
+The parity is the XOR of every packet of the block prefixed with its 2B length, shorter packets
+zero padded, so the length of the missing packet is recovered with it.
+'''
+
+import collections
+import struct
+import zlib
+
+TRAILER = struct.Struct("!HBB")
+LENGTH = struct.Struct("<H")
+DATA = 0
+REPAIR = 1
+
+
+def parity_term(packet) -> int:
+    # little endian, so zero padding a shorter packet at its end doesn't change its value
+    return int.from_bytes(LENGTH.pack(len(packet)) + bytes(packet), byteorder='little')
+
+
+def frame(body, block, index, kind) -> bytearray:
+    datagram = bytearray(body)
+    datagram += TRAILER.pack(block, index, kind)
+    datagram += struct.pack("!H", zlib.crc32(datagram) & 0xFFFF)
+    return datagram
+
+
+def is_intact(datagram) -> bool:
+    # same checksum as a wildcat packet's, so the multiplexer can verify either kind
+    return struct.unpack("!H", datagram[-2:])[0] == zlib.crc32(datagram[:-2]) & 0xFFFF
+
+
+class fec_encoder:
+    ''' sender side. A block is closed after k packets or max_delay seconds after its first one,
+    so the tail of a burst is protected too. k adapts to the loss the parity can't cover:
+    a retransmission during a block (two or more losses in it, or a lost parity) halves it,
+    grow_after blocks without one grow it by one, within [min_k, max_k] '''
+    def __init__(self, my_tunnel, timers, my_metrics, k=8, min_k=2, max_k=32, max_delay=0.01, grow_after=4):
+        self.my_tunnel = my_tunnel
+        self.timers = timers
+        self.metrics = my_metrics
+        self.k = k
+        self.min_k = min_k
+        self.max_k = max_k
+        self.max_delay = max_delay
+        self.grow_after = grow_after
+
+        self.block = 0
+        self.index = 0
+        self.parity = 0
+        self.width = 0
+        self.clean_blocks = 0
+        self.last_retransmitted = my_metrics.get("retransmitted")
+
+    def magic_send(self, packet_byte_array):
+        if self.index == 0:
+            self.timers.arm("fec", self.max_delay)
+        self.my_tunnel.magic_send(frame(packet_byte_array, self.block, self.index, DATA))
+        self.parity ^= parity_term(packet_byte_array)
+        self.width = max(self.width, LENGTH.size + len(packet_byte_array))
+        self.index += 1
+        if self.index >= self.k:
+            self.close_block()
+
+    def close_block(self):
+        ''' sends the parity of the packets so far, called when a block fills up or its "fec" timer fires '''
+        if self.index == 0:
+            return
+        self.timers.cancel("fec")
+        self.my_tunnel.magic_send(frame(self.parity.to_bytes(self.width, byteorder='little'), self.block, self.index, REPAIR))
+        self.metrics.count("fec_repairs_sent")
+        self.block = (self.block + 1) & 0xFFFF
+        self.index = 0
+        self.parity = 0
+        self.width = 0
+        self.adapt()
+
+    def adapt(self):
+        retransmitted = self.metrics.get("retransmitted")
+        if retransmitted > self.last_retransmitted:
+            self.k = max(self.min_k, self.k // 2)
+            self.clean_blocks = 0
+        else:
+            self.clean_blocks += 1
+            if self.clean_blocks >= self.grow_after:
+                self.k = min(self.max_k, self.k + 1)
+                self.clean_blocks = 0
+        self.last_retransmitted = retransmitted
+
+
+class fec_block:
+    def __init__(self):
+        self.received = set()
+        self.parity = 0 # XOR of the parity terms of the received data packets
+        self.repair = None
+        self.count = None
+        self.width = 0
+        self.done = False
+
+
+class fec_decoder:
+    ''' receiver side, decode() turns one datagram into the wildcat packets to process: the packet
+    itself and the one it completed by recovery. The last max_blocks blocks are remembered '''
+    def __init__(self, my_metrics, max_blocks=64):
+        self.metrics = my_metrics
+        self.max_blocks = max_blocks
+        self.blocks = collections.OrderedDict()
+
+    def decode(self, datagram) -> list:
+        if len(datagram) < TRAILER.size + 2 or not is_intact(datagram):
+            self.metrics.count("corrupted")
+            return []
+        block_num, index, kind = TRAILER.unpack_from(datagram, len(datagram) - 2 - TRAILER.size)
+        body = datagram[:-2 - TRAILER.size]
+        block = self.get_block(block_num)
+        packets = [body] if kind == DATA else []
+        if block.done:
+            return packets
+        if kind == REPAIR:
+            block.repair = int.from_bytes(body, byteorder='little')
+            block.count = index
+            block.width = len(body)
+        elif index not in block.received:
+            block.received.add(index)
+            block.parity ^= parity_term(body)
+        if block.count is not None and len(block.received) >= block.count - 1:
+            block.done = True
+            if len(block.received) < block.count:
+                packets.append(self.recover(block))
+        return packets
+
+    def recover(self, block) -> bytearray:
+        missing = (block.repair ^ block.parity).to_bytes(block.width, byteorder='little')
+        length, = LENGTH.unpack_from(missing)
+        self.metrics.count("fec_recovered")
+        return bytearray(missing[LENGTH.size:LENGTH.size + length])
+
+    def get_block(self, block_num) -> fec_block:
+        block = self.blocks.get(block_num)
+        if block is None:
+            block = self.blocks[block_num] = fec_block()
+            if len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        return block
@@ -0,0 +1,157 @@
+''' Bulk file transfer over one wildcat connection.
+The sender maps the source file and hands fixed size chunks to wildcat_sender as views into the
+mapping, so the file is never read into the Python heap (the packet is the only copy). The
+receiver's commit sink is a file_sink: it preallocates the destination, maps it and copies every
+in-order chunk to its offset. The payload stream is
+
+    header : 4B magic | 8B file size | 4B chunk size
+    chunks : the file, chunk size bytes each (the last one may be shorter)
+    end    : 32B SHA-256 of the file
+
+so a transfer needs full reliability (allowed_loss 0). Example:
+
+    send_file(my_wildcat_sender, "disk.img")                  # sender, blocks until queued
+    sink = file_sink("copy.img")                              # receiver, instead of common.logger
+    sink.wait(); sink.verified
+'''
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+HEADER = struct.Struct("!4sQI")
+MAGIC = b"WCFT"
+
+
+class progress_meter:
+    ''' prints bytes done / total and throughput at most every interval seconds '''
+    def __init__(self, label, total, interval=1.0, output=print):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.output = output
+        self.done = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    def update(self, nbytes):
+        self.done += nbytes
+        now = time.monotonic()
+        if self.output is not None and now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(now)
+
+    def report(self, now=None):
+        now = now if now is not None else time.monotonic()
+        self.output(f"{self.label}: {self.done / 1e6:.1f} / {self.total / 1e6:.1f} MB, {self.get_throughput(now) / 1e6:.2f} MB/s")
+
+    def get_throughput(self, now=None) -> float:
+        elapsed = (now if now is not None else time.monotonic()) - self.start
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+
+def file_records(path, chunk_size, meter=None):
+    ''' yields the payloads that carry the file at path: header, chunks as views into a read-only
+    mapping (the mapping lives as long as any of them) and the digest '''
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        # an empty file can't be mapped
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) if size > 0 else memoryview(b"")
+    yield HEADER.pack(MAGIC, size, chunk_size)
+    digest = hashlib.sha256()
+    for offset in range(0, size, chunk_size):
+        chunk = view[offset:offset + chunk_size]
+        digest.update(chunk)
+        if meter is not None:
+            meter.update(len(chunk))
+        yield chunk
+    yield digest.digest()
+
+
+def send_file(my_sender, path, chunk_size=None, output=print) -> progress_meter:
+    ''' queues the file at path on my_sender, blocking on backpressure. Returns the progress
+    meter, the transfer is done once my_sender.wait_until_acked() returns '''
+    chunk_size = chunk_size or my_sender.max_payload_size
+    meter = progress_meter("SND", os.path.getsize(path), output=output)
+    for record in file_records(path, chunk_size, meter):
+        my_sender.new_packet(record)
+    return meter
+
+
+class file_sink:
+    ''' commit sink writing a transfer from file_records() to path, in place of common.logger.
+    wait() returns once the digest arrived, verified tells whether it matched '''
+    def __init__(self, path, output=print):
+        self.path = path
+        self.output = output
+        self.size = None
+        self.received = 0
+        self.digest = hashlib.sha256()
+        self.file_handle = None
+        self.mapping = None
+        self.meter = None
+        self.verified = None
+        self.error = None
+        self.done = threading.Event()
+
+    def commit(self, packet, prefix=b""):
+        if self.done.is_set():
+            return
+        if self.size is None:
+            self.open_destination(packet)
+        elif self.received < self.size:
+            self.write_chunk(packet)
+        else:
+            self.finish(bytes(packet))
+
+    def open_destination(self, header):
+        if len(header) != HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+            self.fail("not a file transfer header")
+            return
+        _, self.size, chunk_size = HEADER.unpack(header)
+        self.file_handle = open(self.path, 'w+b')
+        # preallocated, chunks are copied into the mapping at their offsets
+        self.file_handle.truncate(self.size)
+        if self.size > 0:
+            self.mapping = mmap.mmap(self.file_handle.fileno(), self.size)
+        self.meter = progress_meter("RCVR", self.size, output=self.output)
+
+    def write_chunk(self, chunk):
+        end = self.received + len(chunk)
+        if end > self.size:
+            self.fail("more data than announced")
+            return
+        self.mapping[self.received:end] = chunk
+        self.digest.update(chunk)
+        self.received = end
+        self.meter.update(len(chunk))
+
+    def finish(self, digest):
+        self.verified = digest == self.digest.digest()
+        if self.output is not None:
+            self.meter.report()
+            self.output(f"RCVR: {self.path} {self.size} bytes, sha256 {'ok' if self.verified else 'MISMATCH'}")
+        self.close()
+
+    def fail(self, error):
+        self.error = error
+        self.verified = False
+        if self.output is not None:
+            self.output(f"RCVR: file transfer failed, {error}")
+        self.close()
+
+    def wait(self, timeout=None) -> bool:
+        return self.done.wait(timeout)
+
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.flush()
+            self.mapping.close()
+            self.mapping = None
+        if self.file_handle is not None:
+            self.file_handle.close()
+            self.file_handle = None
+        self.done.set()
@@ -0,0 +1,237 @@
+''' Connection setup for the command line endpoints, run on the UDP socket before any data flows.
+The sender proposes its window size, the largest datagram it would send and the optional features
+it wants. The receiver answers with the smaller window, its own datagram limit and the features it
+supports out of those. The sender then probes the path with DF set, largest size first, and takes
+the first probe the receiver acknowledges as the datagram size: packets are filled up to it and
+the receiver sizes its buffer to match. Every message carries a random nonce, a retransmitted one
+arriving after the data started is still answered (handshake_responder.answer) and anything
+else falls through as data.
+A peer that doesn't speak the handshake (--no-handshake) is no error: connect() returns None when
+no HELLO is answered and accept() returns None when data arrives first, leaving it in the socket.
+Both ends then go with their own settings, as without the handshake.
+
+    sender   : settings = connect(udp_socket, addr, window_size, features)
+    receiver : settings = accept(udp_socket, handshake_responder(window_size))
+               settings = await accept_async(udp_socket, responder)     # on an event loop
+'''
+
+import asyncio
+import errno
+import random
+import select
+import socket
+import struct
+import sys
+import time
+
+from common import MAX_UDP_PAYLOAD
+from wildcat_sender import compute_checksum, does_checksum_match
+
+MAGIC = b"WCHS"
+# magic | type | nonce | window size | max datagram size (probe size for probes) | features, then 2B checksum
+MESSAGE = struct.Struct("!4sBIIII")
+CHECKSUM_SIZE = 2
+HELLO = 1
+HELLO_ACK = 2
+PROBE = 3
+PROBE_ACK = 4
+READY = 5
+READY_ACK = 6
+
+# feature flags
+FEC = 1
+COALESCE = 2
+SEQ32 = 4
+SUPPORTED = FEC | COALESCE | SEQ32
+
+# UDP payload sizes tried largest first: jumbo frames, Ethernet, IPv6 minimum MTU, IPv4 minimum
+# reassembly size (IPv4 + UDP headers taken off). Bigger ones can be asked for with max_datagram_size
+PROBE_SIZES = [8972, 1472, 1252, 548]
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+
+
+class settings:
+    ''' what both ends agreed on '''
+    def __init__(self, window_size, max_datagram_size, features, nonce=None):
+        self.window_size = window_size
+        self.max_datagram_size = max_datagram_size
+        self.features = features
+        # tags this session's messages, late ones are told apart from data by it
+        self.nonce = nonce
+
+    def receiver_options(self) -> dict:
+        return {"fec": bool(self.features & FEC), "coalesce": bool(self.features & COALESCE),
+                "seq_bits": 32 if self.features & SEQ32 else 16}
+
+    def sender_options(self) -> dict:
+        options = self.receiver_options()
+        # fill datagrams: everything but the seq num, checksum and FEC trailer is payload
+        options["max_payload_size"] = self.max_datagram_size - options["seq_bits"] // 8 - 2 - (6 if options["fec"] else 0)
+        return options
+
+
+def features_of(options) -> int:
+    ''' feature flags for wildcat_sender / wildcat_receiver keyword options '''
+    return ((FEC if options.get("fec") else 0) | (COALESCE if options.get("coalesce") else 0) |
+            (SEQ32 if options.get("seq_bits", 16) == 32 else 0))
+
+
+def pack(kind, nonce, window_size=0, max_datagram_size=0, features=0, size=None) -> bytearray:
+    message = bytearray(MESSAGE.pack(MAGIC, kind, nonce, window_size, max_datagram_size, features))
+    if size is not None:
+        message += bytes(size - len(message) - CHECKSUM_SIZE) # probe padding
+    message += struct.pack("!H", compute_checksum(message))
+    return message
+
+
+def unpack(datagram):
+    ''' (type, nonce, window size, max datagram size, features) or None if it is no handshake message.
+    Runs on every datagram the endpoints receive: data and ACKs are turned away by their first byte,
+    the magic is compared on the caller's view without copying it '''
+    if len(datagram) < MESSAGE.size + CHECKSUM_SIZE or datagram[0] != MAGIC[0] or datagram[:len(MAGIC)] != MAGIC:
+        return None
+    if not does_checksum_match(datagram):
+        return None
+    return MESSAGE.unpack_from(datagram)[1:]
+
+
+def is_session_message(datagram, nonce) -> bool:
+    ''' whether datagram is a handshake message of session nonce '''
+    message = unpack(datagram)
+    return message is not None and message[1] == nonce
+
+
+def wait_readable(udp_socket, timeout) -> bool:
+    return len(select.select([udp_socket], [], [], timeout)[0]) > 0
+
+
+class handshake_responder:
+    ''' receiver side. answer() returns the reply to a handshake message of this session and None
+    for anything else (data) '''
+    def __init__(self, window_size, max_datagram_size=MAX_UDP_PAYLOAD, supported=SUPPORTED):
+        self.window_size = window_size
+        self.max_datagram_size = max_datagram_size
+        self.supported = supported
+        self.nonce = None
+        self.settings = None
+        self.ready = False
+
+    def answer(self, datagram):
+        message = unpack(datagram)
+        if message is None:
+            return None
+        kind, nonce, window_size, max_datagram_size, features = message
+        if kind == HELLO and self.nonce in (None, nonce):
+            # the first HELLO picks the session, a retransmitted one gets the same answer
+            self.nonce = nonce
+            self.settings = settings(min(self.window_size, window_size), min(self.max_datagram_size, max_datagram_size),
+                                     features & self.supported, nonce)
+            return pack(HELLO_ACK, nonce, self.settings.window_size, self.settings.max_datagram_size, self.settings.features)
+        if nonce != self.nonce:
+            return None
+        if kind == PROBE and max_datagram_size == len(datagram):
+            return pack(PROBE_ACK, nonce, max_datagram_size=max_datagram_size)
+        if kind == READY:
+            self.settings.max_datagram_size = max_datagram_size
+            self.ready = True
+            return pack(READY_ACK, nonce, max_datagram_size=max_datagram_size)
+        return None
+
+
+def answer_next(udp_socket, responder) -> bool:
+    ''' answers the next queued datagram. False if it is no handshake message: the sender doesn't
+    speak the handshake and its data is left in the socket for the data path '''
+    try:
+        datagram, addr = udp_socket.recvfrom(MAX_UDP_PAYLOAD, socket.MSG_PEEK)
+    except (BlockingIOError, InterruptedError):
+        return True
+    if unpack(datagram) is None:
+        return False
+    udp_socket.recvfrom(MAX_UDP_PAYLOAD)
+    reply = responder.answer(datagram)
+    if reply is not None:
+        try:
+            udp_socket.sendto(reply, addr)
+        except BlockingIOError:
+            pass # the sender asks again
+    return True
+
+
+def accept(udp_socket, responder):
+    ''' answers handshake messages until a sender finished its handshake, blocks until one does.
+    Returns the settings, or None if data arrived first '''
+    while not responder.ready:
+        if wait_readable(udp_socket, 1.0) and not answer_next(udp_socket, responder):
+            return None
+    return responder.settings
+
+
+async def accept_async(udp_socket, responder):
+    ''' accept() on the running event loop, udp_socket must be non-blocking '''
+    loop = asyncio.get_running_loop()
+    while not responder.ready:
+        readable = loop.create_future()
+        loop.add_reader(udp_socket, lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(udp_socket)
+        if not answer_next(udp_socket, responder):
+            return None
+    return responder.settings
+
+
+def exchange(udp_socket, addr, message, reply_kind, nonce, timeout, retries, size=None):
+    ''' sends message until a reply_kind answer for nonce (and datagram size, if given) arrives,
+    returns it unpacked or None. Raises the OSError of a send that was too big for the path '''
+    for _ in range(retries):
+        udp_socket.sendto(message, addr)
+        deadline = time.monotonic() + timeout
+        while wait_readable(udp_socket, max(0, deadline - time.monotonic())):
+            try:
+                datagram, _ = udp_socket.recvfrom(MAX_UDP_PAYLOAD)
+            except (BlockingIOError, InterruptedError):
+                continue
+            reply = unpack(datagram)
+            # a late answer to an earlier (larger) probe must not pass for this one
+            if reply is not None and reply[0] == reply_kind and reply[1] == nonce and size in (None, reply[3]):
+                return reply
+    return None
+
+
+def probe_path(udp_socket, addr, nonce, max_datagram_size, timeout=0.2, retries=3) -> int:
+    ''' largest datagram that got through with DF set '''
+    dont_fragment = sys.platform.startswith("linux")
+    if dont_fragment:
+        previous = udp_socket.getsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER)
+        udp_socket.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+    try:
+        sizes = sorted({size for size in [max_datagram_size] + PROBE_SIZES if size <= max_datagram_size}, reverse=True)
+        for size in sizes:
+            try:
+                if exchange(udp_socket, addr, pack(PROBE, nonce, max_datagram_size=size, size=size), PROBE_ACK, nonce, timeout, retries, size):
+                    return size
+            except OSError as e:
+                if e.errno != errno.EMSGSIZE:
+                    raise
+                # larger than the MTU the kernel already knows for this route
+        return sizes[-1] if sizes else max_datagram_size
+    finally:
+        if dont_fragment:
+            udp_socket.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, previous)
+
+
+def connect(udp_socket, addr, window_size, features=0, max_datagram_size=PROBE_SIZES[0], timeout=0.5, retries=20):
+    ''' negotiates with the receiver at addr. Returns None if it doesn't answer the HELLO (it doesn't
+    speak the handshake), raises if it stops answering halfway '''
+    nonce = random.getrandbits(32)
+    reply = exchange(udp_socket, addr, pack(HELLO, nonce, window_size, max_datagram_size, features), HELLO_ACK, nonce, timeout, retries)
+    if reply is None:
+        return None
+    _, _, window_size, max_datagram_size, features = reply
+    max_datagram_size = probe_path(udp_socket, addr, nonce, max_datagram_size)
+    if exchange(udp_socket, addr, pack(READY, nonce, max_datagram_size=max_datagram_size), READY_ACK, nonce, timeout, retries,
+                max_datagram_size) is None:
+        raise Exception(f"No handshake answer from {addr}")
+    return settings(window_size, max_datagram_size, features, nonce)
@@ -0,0 +1,147 @@
+import json
+import sys
+import threading
+import time
+
+# trace levels, 0 disables tracing entirely
+EVENTS = 1  # losses, retransmissions, drops
+PACKETS = 2 # every send / ack / commit
+WINDOW = 3  # full window dumps
+
+
+class histogram:
+    ''' log2 bucketed histogram: bucket i counts values in [2^(i-1), 2^i) units.
+    Recording is one bit_length() and a list increment '''
+    def __init__(self, unit=1.0):
+        self.unit = unit
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        self.buckets[min(63, int(value / self.unit).bit_length())] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, p):
+        ''' upper bound of the bucket holding the p-th percentile '''
+        if self.count == 0:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                return min(self.max, (1 << i) * self.unit)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+        }
+
+
+class endpoint_metrics:
+    ''' counters, histograms and optional levelled tracing for one endpoint.
+    Call sites guard traces with "if m.trace_level >= metrics.X:" so the message is never
+    even formatted while tracing is off '''
+    def __init__(self, name, trace_level=0, trace_file=None):
+        self.name = name
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = None
+        self.trace_level = trace_level
+        self.trace_file = trace_file
+        self.dump_thread = None
+        self.dump_stop = threading.Event()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def get(self, name) -> int:
+        return self.counters.get(name, 0)
+
+    def observe(self, name, value, unit=1.0):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = histogram(unit)
+        h.record(value)
+
+    def set_gauges(self, gauges):
+        ''' gauges() is called on every snapshot and returns a dict of current values (srtt, cwnd, ...) '''
+        self.gauges = gauges
+
+    def trace(self, message):
+        print(f"{self.name}: {message}", file=self.trace_file if self.trace_file is not None else sys.stdout)
+
+    def snapshot(self) -> dict:
+        return {
+            "name": self.name,
+            "time": time.time(),
+            "counters": dict(self.counters),
+            "histograms": {name: h.snapshot() for name, h in self.histograms.items()},
+            "gauges": self.gauges() if self.gauges is not None else {},
+        }
+
+    def export(self) -> dict:
+        ''' plain, picklable copy of the counters and histograms, e.g. to ship to another process '''
+        histograms = {}
+        for name, h in self.histograms.items():
+            histograms[name] = histogram(h.unit)
+            histograms[name].merge(h)
+        return {"counters": dict(self.counters), "histograms": histograms}
+
+    def merge(self, state):
+        ''' adds an export() of another endpoint into this one '''
+        for name, n in state["counters"].items():
+            self.count(name, n)
+        for name, h in state["histograms"].items():
+            if name not in self.histograms:
+                self.histograms[name] = histogram(h.unit)
+            self.histograms[name].merge(h)
+
+    def dump_periodically(self, path, interval=1.0):
+        ''' appends a JSON snapshot line to path every interval seconds until stop_dump() '''
+        def dump_loop():
+            with open(path, "a") as f:
+                while not self.dump_stop.wait(interval):
+                    f.write(json.dumps(self.snapshot()) + "\n")
+                    f.flush()
+                f.write(json.dumps(self.snapshot()) + "\n")
+        self.dump_thread = threading.Thread(target=dump_loop, daemon=True)
+        self.dump_thread.start()
+
+    def stop_dump(self):
+        if self.dump_thread is not None:
+            self.dump_stop.set()
+            self.dump_thread.join()
+            self.dump_thread = None
+
+
+def from_options(name, options) -> endpoint_metrics:
+    ''' builds an endpoint's metrics from the --trace=N, --metrics-file and --metrics-interval flags '''
+    my_metrics = endpoint_metrics(name, trace_level=int(options.get("trace", 0)))
+    if "metrics-file" in options:
+        my_metrics.dump_periodically(options["metrics-file"], float(options.get("metrics-interval", 1.0)))
+    return my_metrics
@@ -0,0 +1,264 @@
+''' Many wildcat flows over one UDP socket.
+Every datagram is prefixed with a 4 byte connection id, a flow is identified by
+(peer address, connection id). The connection id is folded into the packet checksum, so a
+corrupted header fails the checksum like a corrupted payload instead of landing in another flow.
+The multiplexer owns the socket, one timer scheduler and one timer thread for all flows; the
+per flow wildcat_sender / wildcat_receiver objects are never started as threads, the same way
+async_transport and the simulator drive them. Example:
+
+    # receiver: accepts any number of senders on one port, all committing into one shared log
+    # as 4B connection id + payload records
+    mux = udp_multiplexer(common.magic_tunnel(0, 0), 8000, allowed_loss, window_size,
+                          my_logger=common.logger(log_format="binary", keep_commits=False))
+    # sender: several flows from one socket
+    mux = udp_multiplexer(common.magic_tunnel(0, 0), 0, allowed_loss, window_size)
+    first = mux.open_flow(("localhost", 8000))
+'''
+
+import random
+import socket
+import struct
+import threading
+import zlib
+
+import common
+import metrics
+import wildcat_receiver
+import wildcat_sender
+
+FLOW_HEADER = struct.Struct("!I")
+
+
+def header_check(header) -> int:
+    ''' xored into the wildcat checksum on the wire, a packet only checks out under the connection id it was sent with '''
+    return zlib.crc32(header) & 0xFFFF
+
+
+class flow_timers:
+    ''' one flow's view of the shared timer_scheduler, its keys are namespaced by the flow key '''
+    def __init__(self, shared, flow_key):
+        self.shared = shared
+        self.flow_key = flow_key
+        self.keys = set()
+
+    def now(self):
+        return self.shared.now()
+
+    def arm(self, key, delay):
+        self.keys.add(key)
+        self.shared.arm((self.flow_key, key), delay)
+
+    def cancel(self, key):
+        self.keys.discard(key)
+        self.shared.cancel((self.flow_key, key))
+
+    def is_armed(self, key) -> bool:
+        return self.shared.is_armed((self.flow_key, key))
+
+    def stop(self):
+        for key in list(self.keys):
+            self.shared.cancel((self.flow_key, key))
+        self.keys = set()
+
+
+class flow_channel:
+    ''' stands in for magic_tunnel on one flow: stamps the connection id on outgoing
+    packets and queues them on the shared tunnel together with the flow's address '''
+    my_recv = None
+
+    def __init__(self, mux, conn_id, addr):
+        self.mux = mux
+        self.header = FLOW_HEADER.pack(conn_id)
+        self.check = header_check(self.header)
+        self.addr = addr
+
+    def magic_send(self, packet_byte_array):
+        datagram = bytearray(self.header)
+        datagram += packet_byte_array
+        datagram[-2] ^= self.check >> 8
+        datagram[-1] ^= self.check & 0xFF
+        self.mux.send_datagram(datagram, self.addr)
+
+
+class flow_sink:
+    ''' an accepted flow's handle on the shared logger, tags every payload with the connection id '''
+    def __init__(self, my_logger, conn_id):
+        self.my_logger = my_logger
+        self.header = FLOW_HEADER.pack(conn_id)
+
+    def commit(self, packet):
+        self.my_logger.commit(packet, self.header)
+
+    def get_free_space(self):
+        # every flow sees the space of the shared logger
+        return self.my_logger.get_free_space() if hasattr(self.my_logger, "get_free_space") else None
+
+    def close(self):
+        pass # the shared logger belongs to whoever created the multiplexer
+
+
+class flow:
+    def __init__(self, conn_id, addr, wildcat, timers, now):
+        self.conn_id = conn_id
+        self.addr = addr
+        self.wildcat = wildcat
+        self.timers = timers
+        self.last_active = now
+
+    def is_idle(self, now, idle_timeout) -> bool:
+        if isinstance(self.wildcat, wildcat_sender.wildcat_sender):
+            # the caller still holds the wildcat_sender open_flow() returned, only close_flow() ends it
+            return False
+        return now - self.last_active >= idle_timeout
+
+
+class udp_multiplexer(common.udp_endpoint):
+    ''' demultiplexes datagrams to per flow wildcat state.
+    With my_logger set, unknown flows are accepted as new wildcat_receivers committing into it
+    (pass keep_commits=False to common.logger so it holds no payloads in memory); senders are
+    created with open_flow() and kept until close_flow(). At most max_flows accepted flows are
+    kept, each costs one window of buffers, so memory stays bounded: a new flow beyond that takes
+    the place of ones idle for idle_timeout seconds, or is refused if none is. A flow is never
+    evicted just for pausing, its sender would go on into a flow the receiver no longer knows.
+    my_tunnel only supplies the send queue, wakeup pipe and simulated loss / corruption.
+    reuse_port lets several processes bind the same port (see workers.py) '''
+    def __init__(self, my_tunnel, port, allowed_loss, window_size, my_logger=None, sender_options=None,
+                 receiver_options=None, idle_timeout=30.0, max_flows=4096, my_metrics=None, reuse_port=False):
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        udp_socket.bind(('', port))
+        super(udp_multiplexer, self).__init__(my_tunnel, udp_socket)
+        self.allowed_loss = allowed_loss
+        self.window_size = window_size
+        self.my_logger = my_logger
+        self.sender_options = sender_options or {}
+        self.receiver_options = receiver_options or {}
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self.metrics = my_metrics if my_metrics is not None else metrics.endpoint_metrics("MUX")
+        self.metrics.set_gauges(lambda: {"flows": len(self.flows)})
+        # shared by every accepted receiver: cheaper per flow, and the totals survive eviction
+        self.flow_metrics = metrics.endpoint_metrics("RCVR", trace_level=self.metrics.trace_level)
+
+        self.flows = {}
+        self.lock = threading.Lock()
+        self.timers = common.timer_scheduler()
+        self.timer_thread = threading.Thread(target=self.run_timers, daemon=True)
+        self.random = random.Random()
+
+    def start(self):
+        super().start()
+        self.timer_thread.start()
+
+    def open_flow(self, addr, conn_id=None) -> wildcat_sender.wildcat_sender:
+        ''' new outgoing flow to addr, returns its wildcat_sender '''
+        with self.lock:
+            while conn_id is None or (addr, conn_id) in self.flows:
+                conn_id = self.random.getrandbits(32)
+            my_flow = self.create_flow(wildcat_sender.wildcat_sender, conn_id, addr, self.my_logger, self.sender_options)
+        return my_flow.wildcat
+
+    def close_flow(self, wildcat):
+        with self.lock:
+            for key, my_flow in list(self.flows.items()):
+                if my_flow.wildcat is wildcat:
+                    self.remove_flow(key)
+
+    def create_flow(self, wildcat_class, conn_id, addr, my_logger, options) -> flow:
+        flow_key = (addr, conn_id)
+        timers = flow_timers(self.timers, flow_key)
+        wildcat = wildcat_class(self.allowed_loss, self.window_size, flow_channel(self, conn_id, addr), my_logger, timers, **options)
+        my_flow = flow(conn_id, addr, wildcat, timers, self.timers.now())
+        self.flows[flow_key] = my_flow
+        self.metrics.count("flows_opened")
+        return my_flow
+
+    def remove_flow(self, flow_key):
+        my_flow = self.flows.pop(flow_key)
+        my_flow.timers.stop()
+
+    def accept_flow(self, conn_id, addr, packet_byte_array):
+        ''' only a first packet (seq 0) opens a flow: anything else is a late packet of an
+        evicted flow, which must not restart at seq 0 '''
+        seq_size = self.receiver_options.get("seq_bits", 16) // 8
+        if self.my_logger is None or wildcat_sender.get_seq_num(packet_byte_array, seq_size) != 0:
+            self.metrics.count("unknown_flow")
+            return None
+        if len(self.flows) >= self.max_flows:
+            self.evict_idle()
+            if len(self.flows) >= self.max_flows:
+                self.metrics.count("flows_rejected")
+                return None
+        return self.create_flow(wildcat_receiver.wildcat_receiver, conn_id, addr, flow_sink(self.my_logger, conn_id),
+                                dict({"my_metrics": self.flow_metrics}, **self.receiver_options))
+
+    def on_datagram(self, udp_data, addr):
+        # a view into the endpoint's receive buffer, the checksum is unmasked in place
+        udp_data = self.my_tunnel.do_magic(udp_data)
+        if udp_data is None:
+            self.my_tunnel.recv_lost += 1
+            return
+        if len(udp_data) < FLOW_HEADER.size + 4:
+            return
+        conn_id, = FLOW_HEADER.unpack_from(udp_data)
+        check = header_check(udp_data[:FLOW_HEADER.size])
+        packet_byte_array = udp_data[FLOW_HEADER.size:]
+        packet_byte_array[-2] ^= check >> 8
+        packet_byte_array[-1] ^= check & 0xFF
+        # checked here, before the lookup, so a corrupted connection id can't open or reach a flow
+        if not wildcat_sender.does_checksum_match(packet_byte_array):
+            self.metrics.count("corrupted")
+            return
+        with self.lock:
+            my_flow = self.flows.get((addr, conn_id))
+            if my_flow is None:
+                my_flow = self.accept_flow(conn_id, addr, packet_byte_array)
+                if my_flow is None:
+                    return
+            my_flow.last_active = self.timers.now()
+        my_flow.wildcat.receive(packet_byte_array)
+
+    def send_datagram(self, datagram, addr):
+        datagram = self.my_tunnel.do_magic(datagram)
+        if datagram is None:
+            self.my_tunnel.send_lost += 1
+            return
+        self.my_tunnel.send_queue.append((datagram, addr))
+        if not self.my_tunnel.wakeup_pending:
+            self.my_tunnel.wakeup_pending = True
+            self.my_tunnel.wake()
+
+    def next_datagram(self):
+        # the shared send queue already holds (packet, address) pairs
+        return self.my_tunnel.get_packet()
+
+    def unget_datagram(self, datagram):
+        self.my_tunnel.unget_packet(datagram)
+
+    def evict_idle(self):
+        now = self.timers.now()
+        for flow_key in [key for key, my_flow in self.flows.items() if my_flow.is_idle(now, self.idle_timeout)]:
+            self.remove_flow(flow_key)
+            self.metrics.count("flows_evicted")
+
+    def run_timers(self):
+        while not self.die:
+            for key in self.timers.wait_expired():
+                flow_key, wildcat_key = key
+                my_flow = self.flows.get(flow_key)
+                if my_flow is not None:
+                    my_flow.timers.keys.discard(wildcat_key)
+                    my_flow.wildcat.timeout_callback(wildcat_key)
+
+    def get_stats(self) -> dict:
+        return self.metrics.snapshot()
+
+    def join(self):
+        self.die = True
+        self.timers.stop()
+        self.timer_thread.join()
+        super().join()
+        with self.lock:
+            for flow_key in list(self.flows):
+                self.remove_flow(flow_key)
@@ -0,0 +1,252 @@
+''' Deterministic in-process network simulator.
+Connects a wildcat_sender to a wildcat_receiver through two simulated links on a discrete
+event virtual clock: no sockets, no threads, no sleeping. Every random draw comes from one
+seeded generator, so the same seed replays the exact same run. Example:
+
+    sim = network_simulator(seed=1, window_size=20, loss_rate=20, corrupt_rate=20, latency=0.05)
+    result = sim.transfer([bytes([i % 256]) for i in range(100)], timeout=60)
+'''
+
+import heapq
+import math
+import random
+
+import wildcat_receiver
+import wildcat_sender
+
+
+class sim_timer_scheduler:
+    ''' timer interface of common.timer_scheduler on top of the simulator's event queue '''
+    def __init__(self, sim, callback=None):
+        self.sim = sim
+        self.callback = callback
+        self.events = {}
+
+    def now(self):
+        return self.sim.now
+
+    def arm(self, key, delay):
+        self.cancel(key)
+        self.events[key] = self.sim.schedule(delay, self.expire, key)
+
+    def cancel(self, key):
+        event = self.events.pop(key, None)
+        if event is not None:
+            self.sim.cancel(event)
+
+    def is_armed(self, key) -> bool:
+        return key in self.events
+
+    def expire(self, key):
+        del self.events[key]
+        self.callback(key)
+
+    def stop(self):
+        for event in self.events.values():
+            self.sim.cancel(event)
+        self.events = {}
+
+
+class sim_link:
+    ''' one direction of the simulated path, stands in for magic_tunnel on the sending endpoint.
+    loss_rate, corrupt_rate, reorder_rate and duplicate_rate are percentages like magic_tunnel's.
+    Packets are serialized at bandwidth bits/s (None = infinite) behind a drop-tail queue of
+    queue_limit bytes, then delayed by latency plus jitter drawn from jitter_distribution
+    ("uniform", "normal" or "exponential"). A reordered packet is held back an extra reorder_delay '''
+    my_recv = None
+
+    def __init__(self, sim, loss_rate=0, corrupt_rate=0, latency=0.01, jitter=0, jitter_distribution="uniform",
+                 reorder_rate=0, reorder_delay=None, duplicate_rate=0, bandwidth=None, queue_limit=None):
+        if jitter_distribution not in ("uniform", "normal", "exponential"):
+            raise Exception(f"Unknown jitter distribution : {jitter_distribution}")
+        self.sim = sim
+        self.random = sim.random
+        self.loss_rate = loss_rate
+        self.corrupt_rate = corrupt_rate
+        self.latency = latency
+        self.jitter = jitter
+        self.jitter_distribution = jitter_distribution
+        self.reorder_rate = reorder_rate
+        self.reorder_delay = reorder_delay if reorder_delay is not None else 2 * latency + jitter
+        self.duplicate_rate = duplicate_rate
+        self.bandwidth = bandwidth
+        self.queue_limit = queue_limit
+        self.busy_until = 0
+
+        self.sent = 0
+        self.lost = 0
+        self.corrupted = 0
+        self.duplicated = 0
+        self.reordered = 0
+        self.queue_drops = 0
+
+    def magic_send(self, packet_byte_array):
+        self.sent += 1
+        if self.random.random() * 100 < self.loss_rate:
+            self.lost += 1
+            return
+        departure = self.sim.now
+        if self.bandwidth is not None:
+            start = max(self.sim.now, self.busy_until)
+            if self.queue_limit is not None and (start - self.sim.now) * self.bandwidth / 8 > self.queue_limit:
+                self.queue_drops += 1
+                return
+            departure = start + len(packet_byte_array) * 8 / self.bandwidth
+            self.busy_until = departure
+        copies = 1
+        if self.random.random() * 100 < self.duplicate_rate:
+            self.duplicated += 1
+            copies = 2
+        for _ in range(copies):
+            pkt = bytearray(packet_byte_array)
+            if self.random.random() * 100 < self.corrupt_rate:
+                self.corrupted += 1
+                bit_to_flip = self.random.randrange(len(pkt) * 8)
+                pkt[bit_to_flip // 8] ^= (1 << (bit_to_flip % 8))
+            delay = departure - self.sim.now + self.latency + self.draw_jitter()
+            if self.random.random() * 100 < self.reorder_rate:
+                self.reordered += 1
+                delay += self.reorder_delay
+            self.sim.schedule(delay, self.deliver, pkt)
+
+    def draw_jitter(self) -> float:
+        if self.jitter == 0:
+            return 0
+        if self.jitter_distribution == "uniform":
+            return self.random.uniform(0, self.jitter)
+        if self.jitter_distribution == "normal":
+            return max(-self.latency, self.random.gauss(0, self.jitter))
+        return self.random.expovariate(1 / self.jitter)
+
+    def deliver(self, packet_byte_array):
+        self.my_recv(packet_byte_array)
+
+    def get_stats(self) -> dict:
+        return {"sent": self.sent, "lost": self.lost, "corrupted": self.corrupted, "duplicated": self.duplicated,
+                "reordered": self.reordered, "queue_drops": self.queue_drops}
+
+
+class memory_logger:
+    ''' commit sink that stays in memory, common.logger would start a (real time) writer thread.
+    With drain_rate (bytes per virtual second) it models a slow consumer behind the commits: the
+    backlog drains at that rate and get_free_space() reports what is left of capacity bytes '''
+    def __init__(self, sim, drain_rate=None, capacity=None):
+        self.sim = sim
+        self.commit_list = []
+        self.commit_times = []
+        self.drain_rate = drain_rate
+        self.capacity = capacity
+        self.backlog = 0
+        self.max_backlog = 0
+        self.drained_at = sim.now
+
+    def commit(self, packet):
+        self.commit_list.append(bytearray(packet))
+        self.commit_times.append(self.sim.now)
+        if self.drain_rate is not None:
+            self.drain()
+            self.backlog += len(packet)
+            self.max_backlog = max(self.max_backlog, self.backlog)
+
+    def drain(self):
+        self.backlog = max(0, self.backlog - (self.sim.now - self.drained_at) * self.drain_rate)
+        self.drained_at = self.sim.now
+
+    def get_free_space(self):
+        if self.drain_rate is None or self.capacity is None:
+            return None
+        self.drain()
+        return max(0, int(self.capacity - self.backlog))
+
+    def get_commit_list(self):
+        return self.commit_list
+
+    def close(self):
+        pass
+
+
+class network_simulator:
+    ''' link_options (latency, jitter, loss_rate, ...) apply to both directions,
+    forward_options / reverse_options override them per direction, sink_options (drain_rate,
+    capacity) make the receiver's commit sink a slow consumer '''
+    def __init__(self, seed=0, window_size=20, allowed_loss=0, sender_options=None, receiver_options=None,
+                 forward_options=None, reverse_options=None, sink_options=None, **link_options):
+        self.random = random.Random(seed)
+        self.now = 0.0
+        self.events = []
+        self.counter = 0
+        self.events_run = 0
+
+        self.forward_link = sim_link(self, **dict(link_options, **(forward_options or {})))
+        self.reverse_link = sim_link(self, **dict(link_options, **(reverse_options or {})))
+        self.my_logger = memory_logger(self, **(sink_options or {}))
+
+        sender_timers = sim_timer_scheduler(self)
+        self.my_sender = wildcat_sender.wildcat_sender(allowed_loss, window_size, self.forward_link, memory_logger(self),
+                                                       sender_timers, **(sender_options or {}))
+        sender_timers.callback = self.my_sender.timeout_callback
+        receiver_timers = sim_timer_scheduler(self)
+        self.my_receiver = wildcat_receiver.wildcat_receiver(allowed_loss, window_size, self.reverse_link, self.my_logger,
+                                                             receiver_timers, **(receiver_options or {}))
+        receiver_timers.callback = self.my_receiver.timeout_callback
+
+        self.forward_link.my_recv = self.my_receiver.receive
+        self.reverse_link.my_recv = self.my_sender.receive
+
+    def schedule(self, delay, callback, *args):
+        event = [self.now + max(0, delay), self.counter, callback, args, True]
+        self.counter += 1
+        heapq.heappush(self.events, event)
+        return event
+
+    def cancel(self, event):
+        event[4] = False
+
+    def run(self, until=math.inf, stop=None) -> bool:
+        ''' processes events in time order until the clock passes until, stop() returns True
+        or nothing is left to do. Returns whether stop() was satisfied '''
+        while True:
+            if stop is not None and stop():
+                return True
+            if not self.events:
+                return False
+            event = heapq.heappop(self.events)
+            if not event[4]:
+                continue
+            if event[0] > until:
+                heapq.heappush(self.events, event)
+                return False
+            self.now = event[0]
+            self.events_run += 1
+            event[2](*event[3])
+
+    def transfer(self, payloads, timeout=60) -> dict:
+        ''' sends payloads (without blocking, the backlog is topped up as it drains) and runs the
+        clock until all were committed or timeout virtual seconds passed '''
+        pending = iter(payloads)
+        next_payload = [next(pending, None)]
+        total = [0 if next_payload[0] is None else 1]
+
+        def feed():
+            while next_payload[0] is not None and self.my_sender.new_packet(next_payload[0], block=False):
+                next_payload[0] = next(pending, None)
+                if next_payload[0] is not None:
+                    total[0] += 1
+
+        def done():
+            feed()
+            # packets the receiver gave up on (allowed_loss) are resolved too
+            return next_payload[0] is None and len(self.my_logger.commit_list) + self.my_receiver.count_fail >= total[0]
+
+        start = self.now
+        completed = self.run(until=start + timeout, stop=done)
+        return {
+            "completed": completed,
+            "delivered": len(self.my_logger.commit_list),
+            "skipped": self.my_receiver.count_fail,
+            "virtual_time": self.now - start,
+            "events": self.events_run,
+            "commit_list": self.my_logger.commit_list,
+            "forward": self.forward_link.get_stats(),
+            "reverse": self.reverse_link.get_stats(),
+        }
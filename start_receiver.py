@@ -1,58 +1,61 @@
 import sys
 import socket
+import asyncio
 import common
+import metrics
+import multiplex
+import workers
+import json
+import async_transport
+import file_transfer
+import handshake
 import wildcat_receiver
-import select
 import threading
 import queue
 import traceback
 import time
 
-class UDP_receiver(threading.Thread):
+class UDP_receiver(common.udp_endpoint):
     def __init__(self, port, my_tunnel):
-        super(UDP_receiver, self).__init__()
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.bind(('', port))
+        super(UDP_receiver, self).__init__(my_tunnel, udp_socket)
         self.port = port
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udp_socket.bind(('', self.port))
-        self.inputs = [self.udp_socket]
-        self.outputs = [self.udp_socket]
-        self.my_tunnel = my_tunnel
-        self.die = False
-        self.peer_addr = (0, 0)
-    
-    def run(self):
-        while not self.die:
-            try:
-                readable, writable, exceptional = select.select(self.inputs, self.outputs, self.inputs)
-                for r in readable:
-                    udp_data, client_addr = r.recvfrom(4096)
-                    self.peer_addr = client_addr
-                    self.my_tunnel.magic_recv(bytearray(udp_data))
-                for w in writable:
-                    next_pkt = self.my_tunnel.get_packet()
-                    if(next_pkt == None):
-                        pass
-                    else:
-                        w.sendto(next_pkt, self.peer_addr)
-                for e in exceptional:
-                    traceback.print_exc()
-            except Exception as e:
-                traceback.print_exc()
-        self.udp_socket.close()
+        # answers handshake retransmits that show up once data is flowing
+        self.responder = None
+
+    def on_datagram(self, udp_data, client_addr):
+        if self.responder is not None:
+            reply = self.responder.answer(udp_data)
+            if reply is not None:
+                try:
+                    self.udp_socket.sendto(reply, client_addr)
+                except BlockingIOError:
+                    pass # the sender asks again
+                return
+        # ACKs go back to whoever sent last
+        self.send_addr = client_addr
+        self.my_tunnel.magic_recv(udp_data)
 
-    def join(self):
-        self.die = True
-        super().join()
+async def run_asyncio(port, allowed_loss, window_size, loss_rate, corrupt_rate, my_logger, **receiver_options):
+    endpoint = await async_transport.create_receiver(port, allowed_loss, window_size, loss_rate, corrupt_rate, my_logger, **receiver_options)
+    if endpoint.session is not None:
+        print(f"RCVR: window {endpoint.session.window_size}, {endpoint.session.max_datagram_size} byte datagrams")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        endpoint.close()
 
 if __name__ == '__main__':
-    if(len(sys.argv) != 6):
+    args, options = common.split_args(sys.argv)
+    if(len(args) != 6):
         raise Exception("Wrong number of argument!")
 
-    port = int(sys.argv[1])
-    allowed_loss = int(sys.argv[2])
-    window_size = int(sys.argv[3])
-    loss_rate = int(sys.argv[4])
-    corrupt_rate = int(sys.argv[5])
+    port = int(args[1])
+    allowed_loss = int(args[2])
+    window_size = int(args[3])
+    loss_rate = int(args[4])
+    corrupt_rate = int(args[5])
 
     if(allowed_loss > 100 or allowed_loss < 0):
         raise Exception("allowed_loss our of range")
@@ -62,18 +65,109 @@ if __name__ == '__main__':
 
     if(corrupt_rate > 100 or corrupt_rate < 0):
         raise Exception("corrupt_rate our of range")
-    
-    my_logger = common.logger()
+
+    receiver_options = {"ack_every": int(options.get("ack-every", 1)), "ack_delay": float(options.get("ack-delay", 0.02)),
+                        "seq_bits": int(options.get("seq-bits", 16)), "fec": "fec" in options,
+                        "skip_after": float(options.get("skip-after", 0.2)), "coalesce": "coalesce" in options}
+
+    if "asyncio" in options:
+        my_logger = common.logger(log_format=options.get("log-format", "text"), fsync_policy=options.get("fsync", "never"))
+        my_metrics = metrics.from_options("RCVR", options)
+        loop = async_transport.new_event_loop()
+        try:
+            loop.run_until_complete(run_asyncio(port, allowed_loss, window_size, loss_rate, corrupt_rate, my_logger,
+                                                my_metrics=my_metrics, negotiate="no-handshake" not in options,
+                                                max_datagram_size=int(options.get("max-datagram", common.MAX_UDP_PAYLOAD)),
+                                                **receiver_options))
+        except KeyboardInterrupt:
+            pass
+        my_metrics.stop_dump()
+        sys.exit(0)
+
+    if "workers" in options:
+        # N processes sharing the port, one commit log shard each, senders need --multiplex
+        pool = workers.worker_pool(int(options["workers"]), port, allowed_loss, window_size, loss_rate, corrupt_rate,
+            log_format=options.get("log-format", "text"), fsync_policy=options.get("fsync", "never"),
+            receiver_options=receiver_options, stats_interval=float(options.get("metrics-interval", 1.0)),
+            idle_timeout=float(options.get("idle-timeout", 30)), max_flows=int(options.get("max-flows", 4096)))
+        pool.start()
+        try:
+            while True:
+                pool.poll(pool.stats_interval)
+                if "metrics-file" in options:
+                    with open(options["metrics-file"], "a") as f:
+                        f.write(json.dumps(pool.aggregate().snapshot()) + "\n")
+        except KeyboardInterrupt:
+            pool.stop()
+            print(json.dumps(pool.aggregate().snapshot()))
+        sys.exit(0)
+
     my_tunnel = common.magic_tunnel(loss_rate, corrupt_rate)
-    my_wildcat_receiver = wildcat_receiver.wildcat_receiver(allowed_loss, window_size, my_tunnel, my_logger)
+
+    if "multiplex" in options:
+        # one receiver per (sender address, connection id), all committing into one log as 4B connection id + payload
+        my_logger = common.logger(log_format=options.get("log-format", "text"), fsync_policy=options.get("fsync", "never"),
+                                  keep_commits=False)
+        mux = multiplex.udp_multiplexer(my_tunnel, port, allowed_loss, window_size, my_logger=my_logger,
+            receiver_options=receiver_options, idle_timeout=float(options.get("idle-timeout", 30)),
+            max_flows=int(options.get("max-flows", 4096)), my_metrics=metrics.from_options("MUX", options))
+        mux.start()
+        try:
+            while True:
+                time.sleep(2)
+        except KeyboardInterrupt:
+            mux.join()
+            mux.metrics.stop_dump()
+            my_logger.close()
+            my_tunnel.close()
+        sys.exit(0)
+
+    udp_receiver = UDP_receiver(port, my_tunnel)
+    if "no-handshake" not in options:
+        # the sender's proposal decides window size, datagram size and features, within our limits
+        udp_receiver.responder = handshake.handshake_responder(window_size, int(options.get("max-datagram", common.MAX_UDP_PAYLOAD)))
+        try:
+            session = handshake.accept(udp_receiver.udp_socket, udp_receiver.responder)
+        except KeyboardInterrupt:
+            udp_receiver.udp_socket.close()
+            my_tunnel.close()
+            sys.exit(0)
+        if session is None:
+            # a sender started with --no-handshake, its data stays queued for the receiver
+            udp_receiver.responder = None
+            print("RCVR: sender skipped the handshake, using the command line settings")
+        else:
+            window_size = session.window_size
+            receiver_options.update(session.receiver_options())
+            udp_receiver.set_max_datagram_size(session.max_datagram_size)
+            print(f"RCVR: window {window_size}, {session.max_datagram_size} byte datagrams")
+
+    if "file" in options:
+        # bulk transfer from a --file sender into this file instead of the commit log
+        my_logger = file_transfer.file_sink(options["file"])
+    else:
+        my_logger = common.logger(log_format=options.get("log-format", "text"), fsync_policy=options.get("fsync", "never"))
+    my_metrics = metrics.from_options("RCVR", options)
+    my_wildcat_receiver = wildcat_receiver.wildcat_receiver(allowed_loss, window_size, my_tunnel, my_logger,
+        my_metrics=my_metrics, **receiver_options)
     my_wildcat_receiver.start()
     my_tunnel.my_recv = my_wildcat_receiver.receive
-    udp_receiver = UDP_receiver(port, my_tunnel)
     udp_receiver.start()
 
     try:
-        while True:
+        if "file" in options:
+            while not my_logger.wait(2):
+                pass
+            # the sender resends the digest until it sees an ACK for it, stay around to answer
             time.sleep(2)
+        else:
+            while True:
+                time.sleep(2)
     except KeyboardInterrupt:
-        udp_receiver.join()
-        my_wildcat_receiver.join()
\ No newline at end of file
+        pass
+    udp_receiver.join()
+    my_wildcat_receiver.join()
+    my_tunnel.close()
+    my_metrics.stop_dump()
+    if "file" in options:
+        sys.exit(0 if my_logger.verified else 1)
\ No newline at end of file
@@ -1,56 +1,70 @@
 import sys
 import socket
+import asyncio
 import common
+import metrics
+import multiplex
+import async_transport
+import file_transfer
+import handshake
 import wildcat_sender
-import select
 import threading
 import queue
 import traceback
 import time
 
-class UDP_sender(threading.Thread):
+class UDP_sender(common.udp_endpoint):
     def __init__(self, ip, port, my_tunnel):
-        super(UDP_sender, self).__init__()
-        self.send_addr = (ip, port)
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.inputs = [self.udp_socket]
-        self.outputs = [self.udp_socket]
-        self.my_tunnel = my_tunnel
-        self.die = False
-    
-    def run(self):
-        while not self.die:
-            try:
-                readable, writable, exceptional = select.select(self.inputs, self.outputs, self.inputs)
-                for r in readable:
-                    udp_data, _ = r.recvfrom(4096)
-                    self.my_tunnel.magic_recv(bytearray(udp_data))
-                for w in writable:
-                    next_pkt = self.my_tunnel.get_packet()
-                    if(next_pkt == None):
-                        pass
-                    else:
-                        w.sendto(next_pkt, self.send_addr)
-                for e in exceptional:
-                    traceback.print_exc()
-            except Exception as e:
-                traceback.print_exc()
-        self.udp_socket.close()
+        super(UDP_sender, self).__init__(my_tunnel, socket.socket(socket.AF_INET, socket.SOCK_DGRAM), (ip, port))
+        # nonce of the handshake session, if there was one
+        self.nonce = None
+
+    def on_datagram(self, udp_data, addr):
+        # answers to handshake retransmits can trail in after connect() returned, they would pass
+        # the ACK checksum and read as a cumulative ACK far ahead
+        if self.nonce is not None and handshake.is_session_message(udp_data, self.nonce):
+            return
+        self.my_tunnel.magic_recv(udp_data)
+
+async def stdin_lines(loop):
+    # read stdin on the loop instead of in an executor thread: a thread blocked in input()
+    # keeps the process alive after Ctrl-C
+    reader = asyncio.StreamReader()
+    try:
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    except ValueError:
+        # redirected from a regular file, which can't be polled but never blocks either
+        while line := await loop.run_in_executor(None, sys.stdin.buffer.readline):
+            yield line.rstrip(b"\n")
+        return
+    while line := await reader.readline():
+        yield line.rstrip(b"\n")
 
-    def join(self):
-        self.die = True
-        super().join()
+async def run_asyncio(ip, port, allowed_loss, window_size, loss_rate, corrupt_rate, **sender_options):
+    loop = asyncio.get_running_loop()
+    endpoint = await async_transport.create_sender(ip, port, allowed_loss, window_size, loss_rate, corrupt_rate, **sender_options)
+    if endpoint.session is not None:
+        print(f"SND: window {endpoint.session.window_size}, {endpoint.session.max_datagram_size} byte datagrams")
+    try:
+        async for s in stdin_lines(loop):
+            # never block the loop thread on backpressure, back off until the backlog drains
+            while not endpoint.wildcat.new_packet(bytearray(s), block=False):
+                await asyncio.sleep(0.01)
+        await asyncio.Event().wait() # keep retransmitting what is still in flight until interrupted
+    finally:
+        endpoint.close()
 
 if __name__ == '__main__':
-    if(len(sys.argv) != 7):
+    args, options = common.split_args(sys.argv)
+    if(len(args) != 7):
         raise Exception("Wrong number of argument!")
     
-    ip = sys.argv[1]
-    port = int(sys.argv[2])
-    allowed_loss = int(sys.argv[3])
-    window_size = int(sys.argv[4])
-    loss_rate = int(sys.argv[5])
-    corrupt_rate = int(sys.argv[6])
+    ip = args[1]
+    port = int(args[2])
+    allowed_loss = int(args[3])
+    window_size = int(args[4])
+    loss_rate = int(args[5])
+    corrupt_rate = int(args[6])
 
     if(allowed_loss > 100 or allowed_loss < 0):
         raise Exception("allowed_loss our of range")
@@ -61,18 +75,76 @@ if __name__ == '__main__':
     if(corrupt_rate > 100 or corrupt_rate < 0):
         raise Exception("corrupt_rate our of range")
 
+    sender_options = {"congestion_control": options.get("cc"), "pacing": "pacing" in options,
+                      "seq_bits": int(options.get("seq-bits", 16)), "fec": "fec" in options,
+                      "coalesce": "coalesce" in options}
+
+    if "asyncio" in options:
+        my_metrics = metrics.from_options("SND", options)
+        loop = async_transport.new_event_loop()
+        try:
+            loop.run_until_complete(run_asyncio(ip, port, allowed_loss, window_size, loss_rate, corrupt_rate,
+                                                my_metrics=my_metrics, negotiate="no-handshake" not in options,
+                                                max_datagram_size=int(options.get("max-datagram", handshake.PROBE_SIZES[0])),
+                                                **sender_options))
+        except KeyboardInterrupt:
+            pass
+        my_metrics.stop_dump()
+        sys.exit(0)
+
     my_tunnel = common.magic_tunnel(loss_rate, corrupt_rate)
+
+    if "multiplex" in options:
+        # talks to a --multiplex receiver, --conn-id picks the flow (random otherwise)
+        mux = multiplex.udp_multiplexer(my_tunnel, 0, allowed_loss, window_size, sender_options=sender_options)
+        mux.start()
+        conn_id = int(options["conn-id"]) if "conn-id" in options else None
+        # flows are keyed by the address datagrams come back from, so resolve the name up front
+        my_wildcat_sender = mux.open_flow((socket.gethostbyname(ip), port), conn_id)
+        try:
+            while True:
+                s = input()
+                my_wildcat_sender.new_packet(bytearray(str.encode(s)))
+        except KeyboardInterrupt:
+            mux.join()
+            my_tunnel.close()
+        sys.exit(0)
+
+    udp_sender = UDP_sender(ip, port, my_tunnel)
+    if "no-handshake" not in options:
+        # window size, datagram size and features are agreed on with the receiver, payloads fill the datagrams
+        session = handshake.connect(udp_sender.udp_socket, udp_sender.send_addr, window_size, handshake.features_of(sender_options),
+                                    int(options.get("max-datagram", handshake.PROBE_SIZES[0])))
+        if session is None:
+            print("SND: no handshake answer, the receiver runs with --no-handshake? Using the command line settings")
+        else:
+            udp_sender.nonce = session.nonce
+            window_size = session.window_size
+            sender_options.update(session.sender_options())
+            print(f"SND: window {window_size}, {session.max_datagram_size} byte datagrams")
     my_logger = common.logger()
-    my_wildcat_sender = wildcat_sender.wildcat_sender(allowed_loss, window_size, my_tunnel, my_logger)
+    my_metrics = metrics.from_options("SND", options)
+    my_wildcat_sender = wildcat_sender.wildcat_sender(allowed_loss, window_size, my_tunnel, my_logger,
+        my_metrics=my_metrics, **sender_options)
     my_wildcat_sender.start()
     my_tunnel.my_recv = my_wildcat_sender.receive
-    udp_sender = UDP_sender(ip, port, my_tunnel)
     udp_sender.start()
     
     try:
-        while True:
-            s = input()
-            my_wildcat_sender.new_packet(bytearray(str.encode(s)))
+        if "file" in options:
+            # bulk transfer to a --file receiver, done once everything was acked
+            chunk_size = int(options["chunk-size"]) if "chunk-size" in options else None
+            meter = file_transfer.send_file(my_wildcat_sender, options["file"], chunk_size)
+            my_wildcat_sender.wait_until_acked()
+            meter.report()
+        else:
+            while True:
+                s = input()
+                my_wildcat_sender.new_packet(bytearray(str.encode(s)))
     except KeyboardInterrupt:
-        udp_sender.join()
-        my_wildcat_sender.join()
+        pass
+    udp_sender.join()
+    my_wildcat_sender.join()
+    my_tunnel.close()
+    my_logger.close()
+    my_metrics.stop_dump()
@@ -6,6 +6,20 @@ import wildcat_receiver
 import wildcat_sender
 import time
 import inspect
+import random
+import struct
+import socket
+import asyncio
+import async_transport
+import congestion
+import fec
+import file_transfer
+import handshake
+import simulator
+import metrics
+import multiplex
+import threading
+import workers
 
 class sender:
     def __init__(self, ip, port, allowed_lost, window_size, loss_rate, corrupt_rate, log_file):
@@ -23,6 +37,8 @@ class sender:
     def stop(self):
         self.my_wildcat_sender.join()
         self.udp_sender.join()
+        self.my_tunnel.close()
+        self.my_logger.close()
 
 class receiver:
     def __init__(self, port, allowed_lost, window_size, loss_rate, corrupt_rate, log_file):
@@ -40,15 +56,19 @@ class receiver:
     def stop(self):
         self.my_wildcat_receiver.join()
         self.udp_receiver.join()
+        self.my_tunnel.close()
 
 def run_test(ip, port, allowed_lost, window_size, loss_rate, corrupt_rate, send_list, timeout, log_file):
-    my_sender = sender(ip, port, allowed_lost, window_size, loss_rate, corrupt_rate, log_file)
     my_receiver = receiver(port, allowed_lost, window_size, loss_rate, corrupt_rate, log_file)
+    # port 0 lets the kernel pick a free one, the sender is pointed at whatever was bound
+    port = my_receiver.udp_receiver.udp_socket.getsockname()[1]
+    my_sender = sender(ip, port, allowed_lost, window_size, loss_rate, corrupt_rate, log_file)
     
     for pkt in send_list:
         my_sender.send(pkt)
     
-    time.sleep(timeout)
+    # timeout is only the budget, return as soon as everything was delivered
+    my_receiver.my_logger.wait_for_commits(len(send_list), timeout)
     commit_list = my_receiver.get_commit_list()
     my_receiver.stop()
     my_sender.stop()
@@ -60,7 +80,7 @@ class TestReliableNoLossNoCorrupt(unittest.TestCase):
     allowed_lost = 0
     window_size = 20
     ip = "localhost"
-    port = 8000
+    port = 0
     my_sender = None
     my_receiver = None
 
@@ -92,7 +112,7 @@ class TestReliableWithLossWithCorrupt(unittest.TestCase):
     allowed_lost = 0
     window_size = 20
     ip = "localhost"
-    port = 8000
+    port = 0
     my_sender = None
     my_receiver = None
 
@@ -107,5 +127,603 @@ class TestReliableWithLossWithCorrupt(unittest.TestCase):
         print("Sent " + str(len(send_list)) + " packets, received " + str(len(commit_list)) + " packets")
         assert sorted(send_list) == sorted(commit_list)
 
+class TestAsyncTransport(unittest.TestCase):
+    port = 0
+
+    def test_send_50_pkt_one_loop(self):
+        log_file = "log/" + str(self.__class__.__name__) + "_" + str(inspect.stack()[0][3])
+        send_list = [bytearray([i%256]) for i in range(50)]
+
+        async def transfer():
+            my_receiver = await async_transport.create_receiver(self.port, 0, 20, 10, 10, common.logger(log_file))
+            port = my_receiver.transport.get_extra_info("sockname")[1]
+            my_sender = await async_transport.create_sender("localhost", port, 0, 20, 10, 10, common.logger(log_file))
+            for pkt in send_list:
+                my_sender.wildcat.new_packet(pkt)
+            for _ in range(400):
+                if len(my_receiver.my_logger.get_commit_list()) >= len(send_list):
+                    break
+                await asyncio.sleep(0.05)
+            my_sender.close()
+            my_receiver.close()
+            return my_receiver.my_logger.get_commit_list()
+
+        loop = async_transport.new_event_loop()
+        commit_list = loop.run_until_complete(transfer())
+        loop.close()
+        assert sorted(send_list) == sorted(commit_list)
+
+    def test_handshake_on_the_loop(self):
+        log_file = "log/" + str(self.__class__.__name__) + "_" + str(inspect.stack()[0][3])
+        send_list = [bytearray([i%256]) for i in range(50)]
+
+        async def transfer():
+            probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+            probe.close()
+            # the receiver waits for the handshake on the same loop the sender runs it from
+            receiving = asyncio.ensure_future(async_transport.create_receiver(port, 0, 10, 0, 0, common.logger(log_file), negotiate=True))
+            my_sender = await async_transport.create_sender("127.0.0.1", port, 0, 20, 0, 0, common.logger(log_file), negotiate=True)
+            my_receiver = await receiving
+            assert my_sender.session.window_size == my_receiver.session.window_size == 10
+            assert my_sender.wildcat.window_size == my_receiver.wildcat.window_size == 10
+            for pkt in send_list:
+                my_sender.wildcat.new_packet(pkt)
+            for _ in range(400):
+                if len(my_receiver.my_logger.get_commit_list()) >= len(send_list):
+                    break
+                await asyncio.sleep(0.05)
+            my_sender.close()
+            my_receiver.close()
+            return my_receiver.my_logger.get_commit_list()
+
+        loop = async_transport.new_event_loop()
+        commit_list = loop.run_until_complete(transfer())
+        loop.close()
+        assert send_list == commit_list
+
+class TestLogger(unittest.TestCase):
+    def test_binary_log_round_trip(self):
+        log_file = "log/" + str(self.__class__.__name__) + "_" + str(inspect.stack()[0][3])
+        my_logger = common.logger(log_file, log_format="binary", flush_bytes=16)
+        send_list = [bytes([i%256]) * (i % 7) for i in range(100)]
+        for pkt in send_list:
+            my_logger.commit(pkt)
+        my_logger.close()
+        assert my_logger.get_commit_list() == send_list
+        assert list(common.read_commit_log(log_file)) == send_list
+
+    def test_commit_from_reused_buffer(self):
+        log_file = "log/" + str(self.__class__.__name__) + "_" + str(inspect.stack()[0][3])
+        my_logger = common.logger(log_file, log_format="binary", keep_commits=False)
+        recv_buffer = bytearray(8)
+        for i in range(10):
+            recv_buffer[:] = bytes([i]) * 8
+            my_logger.commit(memoryview(recv_buffer)[:4], b"id")
+        my_logger.close()
+        assert list(common.read_commit_log(log_file)) == [b"id" + bytes([i]) * 4 for i in range(10)]
+
+class fake_tunnel:
+    def __init__(self):
+        self.sent = []
+
+    def magic_send(self, packet_byte_array):
+        self.sent.append(packet_byte_array)
+
+def make_data_packet(seq_num, payload):
+    body = struct.pack("!H", seq_num) + payload
+    return bytearray(body + struct.pack("!H", wildcat_sender.compute_checksum(body)))
+
+class TestReceiverWindow(unittest.TestCase):
+    def test_out_of_order_bitmap_and_commit(self):
+        log_file = "log/" + str(self.__class__.__name__) + "_" + str(inspect.stack()[0][3])
+        my_tunnel = fake_tunnel()
+        my_logger = common.logger(log_file)
+        my_receiver = wildcat_receiver.wildcat_receiver(0, 8, my_tunnel, my_logger)
+        for seq_num in [2, 3, 5]:
+            my_receiver.receive(make_data_packet(seq_num, bytes([seq_num])))
+        ack = my_tunnel.sent[-1]
+        assert wildcat_sender.get_seq_num(ack) == 0
+        assert wildcat_sender.extract_window_bitmap(ack) == 0b101100
+        assert my_receiver.is_outside_window(8)
+
+        for seq_num in [0, 1, 4]:
+            my_receiver.receive(make_data_packet(seq_num, bytes([seq_num])))
+        ack = my_tunnel.sent[-1]
+        assert wildcat_sender.get_seq_num(ack) == 6
+        assert wildcat_sender.extract_window_bitmap(ack) == 0
+        assert my_logger.get_commit_list() == [bytes([i]) for i in range(6)]
+        my_logger.close()
+
+class TestFastRetransmit(unittest.TestCase):
+    def test_resend_hole_once(self):
+        my_tunnel = fake_tunnel()
+        my_sender = wildcat_sender.wildcat_sender(0, 8, my_tunnel, None)
+        for i in range(6):
+            my_sender.new_packet(bytes([i]))
+        # receiver holds 1..3 and 5 but is missing 0 and 4: only 0 has 3 SACKs above it
+        ack = make_data_packet(0, wildcat_sender.encode_sack(0b101110))
+        my_sender.receive(ack)
+        my_sender.receive(ack)
+        assert my_sender.metrics.get("fast_retransmitted") == 1
+        assert my_tunnel.sent[-1] == my_tunnel.sent[0]
+        assert sorted(my_sender.inflight_window.keys()) == [0, 4]
+        my_sender.timers.stop()
+
+class TestSackEncoding(unittest.TestCase):
+    def test_ranges_for_long_runs_bitmap_for_scattered(self):
+        long_runs = ((1 << 5000) - 1) << 3 | 1 << 6000 # holes at 0..2 and 5003..5999
+        ack = make_data_packet(0, wildcat_sender.encode_sack(long_runs))
+        assert len(ack) == 2 + 1 + 2 * 4 + 2
+        assert wildcat_sender.extract_sack_ranges(ack) == [(3, 5003), (6000, 6001)]
+        assert wildcat_sender.extract_window_bitmap(ack) == long_runs
+        scattered = 0b1010110100101
+        ack = make_data_packet(0, wildcat_sender.encode_sack(scattered))
+        assert len(ack) == 2 + 1 + 2 + 2 and wildcat_sender.extract_window_bitmap(ack) == scattered
+
+    def test_large_window_with_32_bit_seq_nums(self):
+        # 40000 packets wrap nothing in 32 bits, but the window alone is past what 16 bit seq nums allow
+        sim = simulator.network_simulator(seed=5, window_size=40000, loss_rate=1, latency=0.005, bandwidth=1e9,
+                                          sender_options={"seq_bits": 32}, receiver_options={"seq_bits": 32})
+        result = sim.transfer([struct.pack("!I", i) for i in range(40000)], timeout=60)
+        assert result["completed"]
+        assert result["commit_list"] == [struct.pack("!I", i) for i in range(40000)]
+        self.assertRaises(Exception, wildcat_sender.wildcat_sender, 0, 40000, None, None)
+
+class TestDelayedAck(unittest.TestCase):
+    def test_coalesce_in_order_ack_out_of_order_now(self):
+        log_file = "log/" + str(self.__class__.__name__) + "_" + str(inspect.stack()[0][3])
+        my_tunnel = fake_tunnel()
+        my_logger = common.logger(log_file)
+        my_receiver = wildcat_receiver.wildcat_receiver(0, 16, my_tunnel, my_logger, ack_every=4, ack_delay=60)
+        for seq_num in range(8):
+            my_receiver.receive(make_data_packet(seq_num, bytes([seq_num])))
+        assert [wildcat_sender.get_seq_num(ack) for ack in my_tunnel.sent] == [4, 8]
+        my_receiver.receive(make_data_packet(10, b"x"))
+        assert wildcat_sender.get_seq_num(my_tunnel.sent[-1]) == 8 and len(my_tunnel.sent) == 3
+        assert my_receiver.get_stats()["ack_ratio"] == 3 / 9
+        my_receiver.timers.stop()
+        my_logger.close()
+
+class TestSenderBacklog(unittest.TestCase):
+    def test_segmentation_and_backpressure(self):
+        my_tunnel = fake_tunnel()
+        my_sender = wildcat_sender.wildcat_sender(0, 4, my_tunnel, None, max_payload_size=10, max_queued=3)
+        # 4 fit the window, 3 fill the backlog, the rest is refused instead of queued without bound
+        assert my_sender.send_stream(bytes(range(100)), block=False) == 7
+        assert len(my_tunnel.sent) == 4
+        assert wildcat_sender.get_payload(my_tunnel.sent[1]) == bytes(range(10, 20))
+        assert not my_sender.new_packet(b"x", block=False)
+        assert not my_sender.new_packet(b"x", timeout=0.01)
+        my_sender.timers.stop()
+
+class TestCoalescing(unittest.TestCase):
+    def test_small_messages_share_packets(self):
+        messages = [bytes([i % 256]) * (i % 5) for i in range(5000)]
+        sim = simulator.network_simulator(seed=1, window_size=20, loss_rate=5, latency=0.01,
+                                          sender_options={"coalesce": True}, receiver_options={"coalesce": True})
+        result = sim.transfer(messages, timeout=60)
+        assert result["completed"] and result["commit_list"] == messages
+        assert sim.my_sender.metrics.get("sent") < len(messages) / 100
+
+    def test_first_message_is_not_delayed(self):
+        my_tunnel = fake_tunnel()
+        my_sender = wildcat_sender.wildcat_sender(0, 8, my_tunnel, None, coalesce=True)
+        for i in range(3):
+            my_sender.new_packet(bytes([i]))
+        # nothing was in flight for the first one, the others wait for its ACK
+        assert len(my_tunnel.sent) == 1
+        my_sender.receive(make_data_packet(1, wildcat_sender.encode_sack(0)))
+        assert len(my_tunnel.sent) == 2
+        assert list(wildcat_sender.unpack_messages(wildcat_sender.get_payload(my_tunnel.sent[1]))) == [b"\x01", b"\x02"]
+        my_sender.timers.stop()
+
+class TestFileTransfer(unittest.TestCase):
+    def test_file_round_trip_with_digest(self):
+        source = "log/" + str(self.__class__.__name__) + "_source"
+        destination = "log/" + str(self.__class__.__name__) + "_destination"
+        data = random.Random(1).randbytes(300000)
+        with open(source, "wb") as f:
+            f.write(data)
+        sim = simulator.network_simulator(seed=1, window_size=50, loss_rate=5, corrupt_rate=5, latency=0.01)
+        sink = file_transfer.file_sink(destination, output=None)
+        sim.my_receiver.my_logger = sink
+        records = file_transfer.file_records(source, 1000)
+        next_record = [next(records)]
+        def done():
+            # tops up the sender's backlog like network_simulator.transfer() does
+            while next_record[0] is not None and sim.my_sender.new_packet(next_record[0], block=False):
+                next_record[0] = next(records, None)
+            return sink.done.is_set()
+        assert sim.run(until=60, stop=done)
+        assert sink.verified
+        with open(destination, "rb") as f:
+            assert f.read() == data
+
+class fake_sink:
+    def __init__(self, free):
+        self.free = free
+        self.commit_list = []
+
+    def commit(self, packet):
+        self.commit_list.append(bytes(packet))
+
+    def get_free_space(self):
+        return self.free
+
+class TestFlowControl(unittest.TestCase):
+    def test_advertised_window_and_zero_window_probe(self):
+        my_tunnel = fake_tunnel()
+        my_receiver = wildcat_receiver.wildcat_receiver(0, 8, my_tunnel, fake_sink(6))
+        my_receiver.receive(make_data_packet(0, b"abc"))
+        assert wildcat_sender.get_advertised_window(my_tunnel.sent[-1]) == 2
+        assert wildcat_sender.get_seq_num(my_tunnel.sent[-1]) == 1
+        # the sink caught up: the window update leaves the window out, all of window_size is free again
+        my_receiver.my_logger.free = 30
+        my_receiver.timeout_callback("window")
+        assert my_receiver.metrics.get("window_updates") == 1
+        assert wildcat_sender.get_advertised_window(my_tunnel.sent[-1]) is None
+        my_receiver.timers.stop()
+
+        my_tunnel = fake_tunnel()
+        my_sender = wildcat_sender.wildcat_sender(0, 8, my_tunnel, None)
+        for i in range(5):
+            my_sender.new_packet(bytes([i]))
+        my_sender.receive(make_data_packet(5, wildcat_sender.encode_sack(0, window=0)))
+        for i in range(5, 9):
+            my_sender.new_packet(bytes([i]))
+        assert len(my_tunnel.sent) == 5 and my_sender.timers.is_armed("probe")
+        my_sender.timeout_callback("probe")
+        assert len(my_tunnel.sent) == 6 and my_sender.metrics.get("window_probes") == 1
+        my_sender.receive(make_data_packet(6, wildcat_sender.encode_sack(0, window=2)))
+        assert len(my_tunnel.sent) == 8 and len(my_sender.packet_queue) == 1
+        assert my_sender.probe_interval is None
+        my_sender.timers.stop()
+
+    def test_throughput_follows_slow_sink(self):
+        # the sink consumes 200 kB/s and holds 100 kB: the sender slows down to it instead of
+        # overrunning the receiver, nothing is lost or resent on the way
+        sim = simulator.network_simulator(seed=1, window_size=50, latency=0.01,
+                                          sink_options={"drain_rate": 200000, "capacity": 100000})
+        result = sim.transfer([bytes([i % 256]) * 1000 for i in range(2000)], timeout=60)
+        assert result["completed"]
+        assert 9 < result["virtual_time"] < 11
+        assert sim.my_logger.max_backlog <= 100000
+        assert sim.my_sender.metrics.get("retransmitted") == 0
+
+class TestCongestionControl(unittest.TestCase):
+    def test_newreno_aimd(self):
+        cc = congestion.newreno_controller(initial_cwnd=4)
+        cc.on_ack(4, 0.0, 0.1)
+        assert cc.get_cwnd() == 8 # slow start doubles per window
+        cc.on_loss(1.0, 0.1)
+        cc.on_loss(1.05, 0.1) # same loss episode, no second halving
+        assert cc.get_cwnd() == 4
+        cc.on_ack(4, 2.0, 0.1)
+        assert cc.get_cwnd() == 5 # congestion avoidance, +1 per window
+
+    def test_cubic_recovers_to_w_max(self):
+        cc = congestion.cubic_controller(initial_cwnd=100)
+        cc.on_loss(1.0, 0.1)
+        assert cc.get_cwnd() == 70
+        for i in range(200):
+            cc.on_ack(1, 1.0 + i * 0.05, 0.1)
+        assert cc.get_cwnd() >= 100
+
+    def test_token_bucket(self):
+        pacer = congestion.token_bucket(100, 2, 0.0)
+        assert pacer.consume(0.0) == 0 and pacer.consume(0.0) == 0
+        assert abs(pacer.consume(0.0) - 0.01) < 1e-9
+        assert pacer.consume(0.01) == 0
+
+class TestSimulator(unittest.TestCase):
+    def run_scenario(self, seed):
+        sim = simulator.network_simulator(seed=seed, window_size=20, loss_rate=20, corrupt_rate=20, latency=0.05,
+                                          jitter=0.01, reorder_rate=5, duplicate_rate=5)
+        return sim.transfer([bytearray([i%256]) for i in range(100)], timeout=60)
+
+    def test_paced_transfer_completes(self):
+        # token bucket rounding used to leave the pace timer refiring at the same instant forever
+        sim = simulator.network_simulator(seed=2, window_size=200, loss_rate=5, latency=0.01,
+                                          sender_options={"congestion_control": "newreno", "pacing": True})
+        result = sim.transfer([bytearray([i%256]) for i in range(500)], timeout=60)
+        assert result["completed"]
+        assert result["events"] < 100000
+
+    def test_long_rtt_converges(self):
+        # RTT above a second: the RTO has to be able to grow past it or every packet is resent
+        sim = simulator.network_simulator(seed=1, window_size=20, latency=0.6)
+        result = sim.transfer([bytearray([i%256]) for i in range(200)], timeout=120)
+        assert result["completed"]
+        assert sim.my_sender.rtt.samples > 100
+        assert abs(sim.my_sender.rtt.srtt - 1.2) < 0.1
+        assert sim.my_sender.metrics.get("retransmitted") < 50
+
+    def test_lossy_transfer_is_reproducible(self):
+        result = self.run_scenario(7)
+        assert result["completed"]
+        assert result["commit_list"] == [bytearray([i%256]) for i in range(100)]
+        again = self.run_scenario(7)
+        assert again["virtual_time"] == result["virtual_time"] and again["forward"] == result["forward"]
+
+class TestPartialReliability(unittest.TestCase):
+    def run_scenario(self, allowed_loss):
+        sim = simulator.network_simulator(seed=3, window_size=50, allowed_loss=allowed_loss, loss_rate=10, latency=0.1,
+                                          receiver_options={"skip_after": 0.05})
+        result = sim.transfer([bytearray([i%256]) for i in range(500)], timeout=120)
+        assert result["completed"]
+        commit_times = sim.my_logger.commit_times
+        return sim, result, max(b - a for a, b in zip(commit_times, commit_times[1:]))
+
+    def test_skip_holes_within_allowed_loss(self):
+        sim, result, reliable_stall = self.run_scenario(0)
+        assert result["delivered"] == 500
+        sim, result, stall = self.run_scenario(20)
+        assert 0 < result["skipped"] <= 100 and result["delivered"] + result["skipped"] == 500
+        assert stall < 0.25 < reliable_stall
+        # the receiver's skip notice made the sender drop those packets instead of resending them
+        assert sim.my_sender.metrics.get("abandoned") > 0
+
+    def test_skip_budget(self):
+        my_receiver = wildcat_receiver.wildcat_receiver(10, 8, fake_tunnel(), None)
+        my_receiver.count_success = 90
+        assert my_receiver.get_could_skip_N_packets() == 10
+        my_receiver.count_fail = 4
+        assert my_receiver.get_could_skip_N_packets() == 6
+
+class TestFec(unittest.TestCase):
+    def test_rebuild_missing_packet_from_parity(self):
+        my_tunnel = fake_tunnel()
+        timers = common.timer_scheduler()
+        encoder = fec.fec_encoder(my_tunnel, timers, metrics.endpoint_metrics("SND"), k=4)
+        packets = [make_data_packet(i, bytes(range(i * 3))) for i in range(4)]
+        for packet in packets:
+            encoder.magic_send(packet)
+        assert len(my_tunnel.sent) == 5
+        decoder = fec.fec_decoder(metrics.endpoint_metrics("RCVR"))
+        decoded = []
+        for i, datagram in enumerate(my_tunnel.sent):
+            if i != 2:
+                decoded += decoder.decode(datagram)
+        assert decoded == packets[:2] + packets[3:] + [packets[2]]
+        assert decoder.metrics.get("fec_recovered") == 1
+        timers.stop()
+
+    def test_fewer_retransmissions_under_loss(self):
+        payloads = [bytearray([i%256]) for i in range(300)]
+        retransmitted = {}
+        for use_fec in (False, True):
+            sim = simulator.network_simulator(seed=1, window_size=20, loss_rate=20, latency=0.05,
+                                              sender_options={"fec": use_fec}, receiver_options={"fec": use_fec})
+            result = sim.transfer(payloads, timeout=60)
+            assert result["completed"] and result["commit_list"] == payloads
+            retransmitted[use_fec] = sim.my_sender.metrics.get("retransmitted")
+        assert retransmitted[True] < retransmitted[False] * 0.7
+
+class TestMetrics(unittest.TestCase):
+    def test_counters_match_links(self):
+        sim = simulator.network_simulator(seed=3, window_size=20, loss_rate=10, corrupt_rate=10, latency=0.02)
+        result = sim.transfer([bytearray([i%256]) for i in range(100)], timeout=60)
+        assert result["completed"]
+        sender_stats = sim.my_sender.get_stats()
+        receiver_stats = sim.my_receiver.get_stats()
+        assert sender_stats["counters"]["sent"] + sender_stats["counters"]["retransmitted"] == result["forward"]["sent"]
+        assert receiver_stats["counters"]["committed"] == 100
+        assert receiver_stats["counters"]["acks_sent"] == result["reverse"]["sent"]
+        assert sender_stats["histograms"]["rtt"]["count"] > 0
+
+    def test_histogram_percentiles(self):
+        h = metrics.histogram(unit=1e-3)
+        for ms in range(1, 101):
+            h.record(ms / 1000)
+        assert h.count == 100 and h.min == 0.001 and h.max == 0.1
+        assert 0.032 <= h.percentile(50) <= 0.064
+        assert h.percentile(99) == 0.1
+
+class TestMultiplex(unittest.TestCase):
+    def test_concurrent_flows_over_one_socket(self):
+        # corruption also hits the connection id, none of it may open a bogus flow
+        my_logger = common.logger("log/TestMultiplex_test_concurrent_flows_over_one_socket")
+        receiver_mux = multiplex.udp_multiplexer(common.magic_tunnel(10, 10), 0, 0, 20, my_logger=my_logger)
+        sender_mux = multiplex.udp_multiplexer(common.magic_tunnel(10, 10), 0, 0, 20)
+        port = receiver_mux.udp_socket.getsockname()[1]
+        receiver_mux.start()
+        sender_mux.start()
+        senders = [sender_mux.open_flow(("127.0.0.1", port), conn_id) for conn_id in (1, 2, 3)]
+        for i in range(50):
+            for conn_id, my_sender in zip((1, 2, 3), senders):
+                my_sender.new_packet(bytearray([conn_id, i]))
+        assert my_logger.wait_for_commits(150, 30)
+        records = my_logger.get_commit_list()
+        for conn_id in (1, 2, 3):
+            header = struct.pack("!I", conn_id)
+            assert [r[4:] for r in records if r[:4] == header] == [bytearray([conn_id, i]) for i in range(50)]
+        assert receiver_mux.get_stats()["gauges"]["flows"] == 3
+        sender_mux.join()
+        receiver_mux.join()
+        sender_mux.my_tunnel.close()
+        receiver_mux.my_tunnel.close()
+        my_logger.close()
+
+    def test_paused_flow_keeps_delivering(self):
+        my_logger = common.logger("log/TestMultiplex_test_paused_flow_keeps_delivering")
+        receiver_mux = multiplex.udp_multiplexer(common.magic_tunnel(0, 0), 0, 0, 20, my_logger=my_logger, idle_timeout=0.2, max_flows=1)
+        sender_mux = multiplex.udp_multiplexer(common.magic_tunnel(0, 0), 0, 0, 20, idle_timeout=0.2)
+        port = receiver_mux.udp_socket.getsockname()[1]
+        receiver_mux.start()
+        sender_mux.start()
+        my_sender = sender_mux.open_flow(("127.0.0.1", port), 1)
+        my_sender.new_packet(b"before")
+        assert my_logger.wait_for_commits(1, 5)
+        # idle past the timeout: without a new flow pressing for room neither side drops it
+        time.sleep(0.6)
+        my_sender.new_packet(b"after")
+        assert my_logger.wait_for_commits(2, 5)
+        # with max_flows reached a new flow takes the idle one's place
+        time.sleep(0.3)
+        sender_mux.open_flow(("127.0.0.1", port), 2).new_packet(b"other")
+        assert my_logger.wait_for_commits(3, 5)
+        assert receiver_mux.metrics.get("flows_evicted") == 1 and sender_mux.metrics.get("flows_evicted") == 0
+        sender_mux.join()
+        receiver_mux.join()
+        sender_mux.my_tunnel.close()
+        receiver_mux.my_tunnel.close()
+        my_logger.close()
+
+class TestWorkers(unittest.TestCase):
+    def test_flows_spread_over_worker_shards(self):
+        log_file = "log/" + str(self.__class__.__name__) + "_" + str(inspect.stack()[0][3])
+        pool = workers.worker_pool(2, 0, 0, 20, 0, 0, log_file=log_file, log_format="binary", stats_interval=0.1)
+        pool.start()
+        # separate sockets so the kernel hashes the flows independently
+        sender_muxes = [multiplex.udp_multiplexer(common.magic_tunnel(0, 0), 0, 0, 20) for _ in range(4)]
+        for conn_id, sender_mux in enumerate(sender_muxes):
+            sender_mux.start()
+            my_sender = sender_mux.open_flow(("127.0.0.1", pool.port), conn_id)
+            for i in range(30):
+                my_sender.new_packet(bytearray([conn_id, i]))
+        deadline = time.monotonic() + 30
+        while pool.aggregate().get("committed") < 120 and time.monotonic() < deadline:
+            pool.poll(0.1)
+        for sender_mux in sender_muxes:
+            sender_mux.join()
+            sender_mux.my_tunnel.close()
+        pool.stop()
+        assert pool.aggregate().get("committed") == 120
+        records = [r for index in range(2) for r in common.read_commit_log(pool.shard_file(index))]
+        for conn_id in range(4):
+            header = struct.pack("!I", conn_id)
+            assert [r[4:] for r in records if r[:4] == header] == [bytes([conn_id, i]) for i in range(30)]
+
+class TestBatchedIo(unittest.TestCase):
+    def test_batched_send_and_receive_keep_datagrams(self):
+        received = []
+        receiver_tunnel = common.magic_tunnel(0, 0)
+        receiver_tunnel.my_recv = lambda packet: received.append(bytes(packet))
+        receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver_socket.bind(("127.0.0.1", 0))
+        receiver_endpoint = common.udp_endpoint(receiver_tunnel, receiver_socket)
+        sender_tunnel = common.magic_tunnel(0, 0)
+        sender_endpoint = common.udp_endpoint(sender_tunnel, socket.socket(socket.AF_INET, socket.SOCK_DGRAM),
+                                              receiver_socket.getsockname())
+        # equal sized runs with a shorter packet now and then, those end a GSO batch
+        packets = [bytes([i % 256]) * (100 if i % 50 else 30) for i in range(200)]
+        receiver_endpoint.start()
+        sender_endpoint.start()
+        for packet in packets:
+            sender_tunnel.magic_send(packet)
+        deadline = time.monotonic() + 5
+        while len(received) < len(packets) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        sender_endpoint.join()
+        receiver_endpoint.join()
+        sender_tunnel.close()
+        receiver_tunnel.close()
+        assert received == packets
+
+class TestHandshake(unittest.TestCase):
+    def test_negotiate_window_datagram_size_and_features(self):
+        receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver_socket.bind(("127.0.0.1", 0))
+        responder = handshake.handshake_responder(window_size=100, max_datagram_size=1500, supported=handshake.FEC)
+        accepted = []
+        acceptor = threading.Thread(target=lambda: accepted.append(handshake.accept(receiver_socket, responder)))
+        acceptor.start()
+        sender_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        session = handshake.connect(sender_socket, receiver_socket.getsockname(), 200,
+                                    handshake.features_of({"fec": True, "coalesce": True}))
+        acceptor.join()
+        # the receiver's limit rules out the jumbo probe, loopback carries the limit itself
+        assert (session.window_size, session.max_datagram_size, session.features) == (100, 1500, handshake.FEC)
+        assert accepted[0].max_datagram_size == 1500
+        assert session.sender_options()["max_payload_size"] == 1500 - 2 - 2 - 6
+        # once data flows a late retransmit is still answered, data packets are not mistaken for one
+        assert handshake.unpack(responder.answer(handshake.pack(handshake.READY, responder.nonce, max_datagram_size=1500)))[0] == handshake.READY_ACK
+        assert responder.answer(make_data_packet(0, b"WCHS" + bytes(30))) is None
+        sender_socket.close()
+        receiver_socket.close()
+
+    def test_late_replies_are_not_acks(self):
+        receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver_socket.bind(("127.0.0.1", 0))
+        sender_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender_socket.bind(("127.0.0.1", 0))
+        # an answer to the earlier, larger probe is no answer to this one
+        receiver_socket.sendto(handshake.pack(handshake.PROBE_ACK, 7, max_datagram_size=8972), sender_socket.getsockname())
+        probe = handshake.pack(handshake.PROBE, 7, max_datagram_size=1472, size=1472)
+        assert handshake.exchange(sender_socket, receiver_socket.getsockname(), probe, handshake.PROBE_ACK, 7, 0.1, 1, 1472) is None
+        sender_socket.close()
+        receiver_socket.close()
+
+        my_tunnel = common.magic_tunnel(0, 0)
+        received = []
+        my_tunnel.my_recv = received.append
+        udp_sender = start_sender.UDP_sender("127.0.0.1", 9, my_tunnel)
+        udp_sender.nonce = 7
+        udp_sender.on_datagram(memoryview(handshake.pack(handshake.READY_ACK, 7, max_datagram_size=1472)), None)
+        ack = make_data_packet(3, wildcat_sender.encode_sack(0))
+        udp_sender.on_datagram(memoryview(ack), None)
+        assert received == [ack]
+        udp_sender.udp_socket.close()
+        my_tunnel.close()
+
+    def test_peer_without_handshake(self):
+        receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver_socket.bind(("127.0.0.1", 0))
+        sender_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # a receiver that never answers: the sender goes without the handshake
+        assert handshake.connect(sender_socket, receiver_socket.getsockname(), 20, timeout=0.05, retries=2) is None
+        while handshake.wait_readable(receiver_socket, 0):
+            receiver_socket.recvfrom(common.MAX_UDP_PAYLOAD)
+        # data before any HELLO: accept() gives up and leaves the data for the receiver
+        data = make_data_packet(0, b"data")
+        sender_socket.sendto(data, receiver_socket.getsockname())
+        assert handshake.accept(receiver_socket, handshake.handshake_responder(20)) is None
+        assert receiver_socket.recvfrom(common.MAX_UDP_PAYLOAD)[0] == data
+        sender_socket.close()
+        receiver_socket.close()
+
+class TestTimerScheduler(unittest.TestCase):
+    def test_expire_in_deadline_order(self):
+        timers = common.timer_scheduler()
+        timers.arm(1, 0.02)
+        timers.arm(2, 0.01)
+        timers.arm(3, 0.01)
+        timers.cancel(3)
+        expired = []
+        while len(expired) < 2:
+            expired = expired + timers.wait_expired()
+        assert expired == [2, 1]
+        assert not timers.is_armed(1)
+
+    def test_stop_wakes_waiter(self):
+        timers = common.timer_scheduler()
+        timers.arm(1, 60)
+        timers.stop()
+        assert timers.wait_expired() == []
+
+class TestRttEstimator(unittest.TestCase):
+    def test_sample_and_backoff(self):
+        rtt = wildcat_sender.rtt_estimator(initial_rto=0.5, min_rto=0.01, max_rto=1.0)
+        rtt.sample(0.1)
+        assert rtt.srtt == 0.1 and rtt.rttvar == 0.05
+        assert abs(rtt.rto - 0.3) < 1e-9
+        rtt.backoff()
+        rtt.backoff()
+        assert rtt.rto == 1.0 # clamped to max_rto
+        rtt.reset_backoff()
+        assert abs(rtt.rto - 0.3) < 1e-9
+
+    def test_backoff_limit_follows_rtt(self):
+        rtt = wildcat_sender.rtt_estimator(initial_rto=0.5)
+        for _ in range(10):
+            rtt.backoff()
+        assert rtt.rto == 60.0 # no sample yet, may grow to max_rto
+        rtt.sample(0.0001)
+        for _ in range(10):
+            rtt.backoff()
+        assert rtt.rto == 1.0 # fast path, stops at backoff_floor
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
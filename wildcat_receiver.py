@@ -1,110 +1,214 @@
-import math
-
 import threading
-import struct
-import zlib
 
-from wildcat_sender import get_seq_num, get_ck_sum, does_checksum_match, get_payload
+import common
+import metrics
+from fec import fec_decoder
+from metrics import EVENTS, PACKETS
+from wildcat_sender import get_seq_num, does_checksum_match, encode_sack, sequence_space, build_packet, unpack_messages, SEQ_HEADERS, ACK_SKIPPED
 
 
 class wildcat_receiver(threading.Thread):
-    def __init__(self, allowed_loss, window_size, my_tunnel, my_logger):
+    def __init__(self, allowed_loss, window_size, my_tunnel, my_logger, timers=None, ack_every=1, ack_delay=0.02, my_metrics=None,
+                 seq_bits=16, fec=False, skip_after=0.2, coalesce=False):
         super(wildcat_receiver, self).__init__()
         self.allowed_loss = allowed_loss
         self.window_size = window_size
+        self.seq_size, self.seq_mask, self.seq_half = sequence_space(seq_bits)
+        self.seq_header = SEQ_HEADERS[self.seq_size]
+        if window_size >= self.seq_half:
+            raise Exception(f"window_size {window_size} too large for {seq_bits} bit sequence numbers")
 
         self.rcv_wnd_seq_num = 0
-        self.received_window = {}
+        # fixed size ring, slot (ring_head + distance) % window_size holds seq rcv_wnd_seq_num + distance
+        self.received_window = [None] * window_size
+        self.ring_head = 0
+        # bit i set <=> rcv_wnd_seq_num + i is buffered, kept in sync on insert / commit
+        self.ack_bitmap = 0
 
         self.my_tunnel = my_tunnel
         self.my_logger = my_logger
         self.die = False
+        # receiver side timers, fired from run() (or by the event loop in async_transport)
+        self.timers = timers if timers is not None else common.timer_scheduler()
+        # receive() runs on the UDP thread, the delayed ACK timer on this one
+        self.lock = threading.Lock()
+
+        # delayed ACKs: one cumulative ACK per ack_every in-order packets or after ack_delay seconds
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.unacked_packets = 0
+        # out of order packets currently held in the ring
+        self.buffered = 0
+
+        self.metrics = my_metrics if my_metrics is not None else metrics.endpoint_metrics("RCVR")
+        # rebuilds packets from the sender's parity packets (the sender needs fec=True too)
+        self.fec = fec_decoder(self.metrics) if fec else None
+        # payloads are length prefixed messages packed by a coalescing sender, each is committed on its own
+        self.coalesce = coalesce
 
         self.count_success = 0
         self.count_fail = 0
+        # partial reliability: a hole holding up delivery for skip_after seconds is given up on
+        # if that keeps the loss within allowed_loss percent (None never gives up)
+        self.skip_after = skip_after
+        # the next ACK tells the sender its cumulative seq num jumped over abandoned packets
+        self.skipped = False
+
+        # flow control: a sink with get_free_space() (bytes it takes before falling behind) limits
+        # the window advertised in ACKs to that many packets of the largest payload seen. While it
+        # is below window_size the sink is re-checked every ack_delay seconds and a window update
+        # is sent once it opened by a quarter of the window (or fully)
+        self.sink_space = getattr(my_logger, "get_free_space", None)
+        self.payload_size = 0
+        self.advertised_window = window_size
 
     def receive(self, packet_byte_array):
-        #print(f"received : {packet_byte_array}")
-
+        with self.lock:
+            if self.fec is None:
+                self.process_packet(packet_byte_array)
+                return
+            for packet in self.fec.decode(packet_byte_array):
+                self.process_packet(packet)
+
+    def process_packet(self, packet_byte_array):
         if not does_checksum_match(packet_byte_array):
-            print("RCVR: Dropping corrupted packet")
+            self.metrics.count("corrupted")
+            if self.metrics.trace_level >= EVENTS:
+                self.metrics.trace("Dropping corrupted packet")
             return # drop corrupted packets
 
-        seq_num = get_seq_num(packet_byte_array)
+        seq_num = get_seq_num(packet_byte_array, self.seq_size)
         if self.is_outside_window(seq_num):
-            print(f"RCVR: Dropping packet outside window : {seq_num}")
+            self.metrics.count("dropped_outside_window")
+            if self.metrics.trace_level >= EVENTS:
+                self.metrics.trace(f"Dropping packet outside window : {seq_num}")
+            # still re-ACK, a retransmit of an already committed packet means our last ACK was lost
+            self.send_ack()
             return # drop packet if outside window
 
-        print(f"RCVR:  received packet : {seq_num}")
-
-        payload = get_payload(packet_byte_array)
-        self.received_window[seq_num] = payload
+        self.metrics.count("received")
+        if self.metrics.trace_level >= PACKETS:
+            self.metrics.trace(f"received packet : {seq_num}")
+
+        distance = (seq_num - self.rcv_wnd_seq_num) & self.seq_mask
+        # anything but the next expected packet with no holes behind it is ACKed right away,
+        # the sender needs the bitmap (or the filled hole) without delay to recover quickly
+        out_of_order = distance != 0 or self.ack_bitmap != 0
+        slot = (self.ring_head + distance) % self.window_size
+        if self.received_window[slot] is None:
+            payload = memoryview(packet_byte_array)[self.seq_size:-2]
+            self.payload_size = max(self.payload_size, len(payload))
+            # the next expected packet is committed below, straight from the receive buffer;
+            # anything that waits in the ring must not point into that (reused) buffer
+            self.received_window[slot] = payload if distance == 0 else bytearray(payload)
+            self.ack_bitmap |= (1 << distance)
+            self.buffered += 1
+        else:
+            self.metrics.count("duplicates")
         self.process_window()
+        self.metrics.observe("window_occupancy", self.buffered)
 
+        self.unacked_packets += 1
+        if out_of_order or self.unacked_packets >= self.ack_every:
+            self.send_ack()
+        elif not self.timers.is_armed("ack"):
+            self.timers.arm("ack", self.ack_delay)
+
+    def send_ack(self):
+        self.timers.cancel("ack")
+        self.unacked_packets = 0
         ack = self.create_ack_packet()
         self.my_tunnel.magic_send(ack)
-        print(f"RCVR: Sent ACK : {get_seq_num(ack)}")
+        self.metrics.count("acks_sent")
+        if self.metrics.trace_level >= PACKETS:
+            self.metrics.trace(f"Sent ACK : {self.rcv_wnd_seq_num}")
+        if self.advertised_window < self.window_size and not self.timers.is_armed("window"):
+            self.timers.arm("window", self.ack_delay)
+
+    def get_stats(self) -> dict:
+        stats = self.metrics.snapshot()
+        received = self.metrics.get("received")
+        stats["ack_ratio"] = self.metrics.get("acks_sent") / received if received else 0.0
+        return stats
 
     def is_outside_window(self, seq_num):
-        distance = (seq_num - self.rcv_wnd_seq_num) & 0xFFFF # handles wrap around
-        return distance > self.window_size
+        distance = (seq_num - self.rcv_wnd_seq_num) & self.seq_mask # handles wrap around
+        return distance >= self.window_size # ring has exactly window_size slots
 
     def process_window(self):
-        # Process consecutive packets first
-        while self.rcv_wnd_seq_num in self.received_window:
-            self.my_logger.commit(self.received_window[self.rcv_wnd_seq_num])
-            print(f"RCVR: Committed packet {self.rcv_wnd_seq_num}")
+        # Process consecutive packets first: they are the run of trailing ones in the bitmap
+        in_order = (~self.ack_bitmap & (self.ack_bitmap + 1)).bit_length() - 1
+        for _ in range(in_order):
+            if self.coalesce:
+                for message in unpack_messages(self.received_window[self.ring_head]):
+                    self.my_logger.commit(message)
+            else:
+                self.my_logger.commit(self.received_window[self.ring_head])
+            if self.metrics.trace_level >= PACKETS:
+                self.metrics.trace(f"Committed packet {self.rcv_wnd_seq_num}")
             self.count_success += 1
-            del self.received_window[self.rcv_wnd_seq_num]
-            self.rcv_wnd_seq_num = (self.rcv_wnd_seq_num + 1) & 0xFFFF
-
-        # Check if we can skip packets within allowed loss budget
-        # for could_skip_i in range(1, self.get_could_skip_N_packets() + 1):
-        #     next_valid_seq_num = (self.rcv_wnd_seq_num + could_skip_i) & 0xFFFF
-        #     if next_valid_seq_num in self.received_window:
-        #         print(f"Skipping {could_skip_i} packets, found packet {next_valid_seq_num} in window")
-        #         # Count all skipped packets as failures
-        #         self.count_fail += could_skip_i
-        #         # Process the found packet
-        #         self.my_logger.commit(self.received_window[next_valid_seq_num])
-        #         self.count_success += 1
-        #         del self.received_window[next_valid_seq_num]
-        #         self.rcv_wnd_seq_num = (next_valid_seq_num + 1) & 0xFFFF
-        #         # Recursively process any consecutive packets after this
-        #         return self.process_window()
-
-
-    # maybe better way to implement this logic, but the idea is if you can skip N packets
-    # and the average is will allowable, return that many N used to check if N + 1 are
-    # already received. Then it will skip ahead and drop those <= N packets.
-    def get_could_skip_N_packets(self)->int:
-        count = 0
-        # if avg=(success/(total +1-HYPOTHETICAL_FAIL)) > allowed_loss_avg => could allow +1 packet skip
-        while (self.count_success / (self.count_success + self.count_fail + count + 1)) > ((100 - self.allowed_loss) /100 ):
-            count += 1
-        return count
-
+            self.received_window[self.ring_head] = None
+            self.ring_head = (self.ring_head + 1) % self.window_size
+            self.rcv_wnd_seq_num = (self.rcv_wnd_seq_num + 1) & self.seq_mask
+        self.ack_bitmap >>= in_order
+        self.buffered -= in_order
+        self.metrics.count("committed", in_order)
+
+        if self.ack_bitmap == 0:
+            self.timers.cancel("skip")
+        elif self.allowed_loss > 0 and self.skip_after is not None and (in_order > 0 or not self.timers.is_armed("skip")):
+            # the deadline is per hole, it restarts whenever a different one is at the head of the window
+            self.timers.arm("skip", self.skip_after)
+
+    def skip_hole(self):
+        ''' gives up on the run of missing packets at the head of the window, if the loss budget allows '''
+        if self.ack_bitmap == 0:
+            return
+        gap = (self.ack_bitmap & -self.ack_bitmap).bit_length() - 1 # trailing zeros = missing packets
+        if gap > self.get_could_skip_N_packets():
+            self.metrics.count("skips_over_budget")
+            return
+        if self.metrics.trace_level >= EVENTS:
+            self.metrics.trace(f"Skipping {gap} packets at {self.rcv_wnd_seq_num}")
+        self.count_fail += gap
+        self.metrics.count("skipped", gap)
+        self.ring_head = (self.ring_head + gap) % self.window_size
+        self.rcv_wnd_seq_num = (self.rcv_wnd_seq_num + gap) & self.seq_mask
+        self.ack_bitmap >>= gap
+        self.skipped = True
+        self.process_window()
+        self.send_ack()
+
+    def get_could_skip_N_packets(self) -> int:
+        ''' how many more packets may be lost with count_success / (count_success + count_fail)
+        staying at or above (100 - allowed_loss) percent '''
+        if self.allowed_loss >= 100:
+            return self.window_size
+        return max(0, 100 * self.count_success // (100 - self.allowed_loss) - self.count_success - self.count_fail)
+
+    def get_advertised_window(self) -> int:
+        ''' packets past rcv_wnd_seq_num the sink can still take, buffered ones included '''
+        free = self.sink_space() if self.sink_space is not None and self.payload_size > 0 else None
+        if free is None:
+            return self.window_size
+        return min(self.window_size, free // self.payload_size)
+
+    def update_window(self):
+        ''' "window" timer: tells the sender once the sink caught up, it may be waiting on a closed window '''
+        window = self.get_advertised_window()
+        if window >= self.window_size or window - self.advertised_window >= max(1, self.window_size // 4):
+            self.metrics.count("window_updates")
+            self.send_ack()
+        else:
+            self.timers.arm("window", self.ack_delay)
 
     def create_ack_packet(self):
-        seq_bytes = struct.pack("!H", self.rcv_wnd_seq_num)
-        bitmap = self.create_ack_bitmap()
-        body = seq_bytes + bitmap
-
-        checksum = zlib.crc32(body) & 0xFFFF
-        ck_bytes = struct.pack("!H", checksum)
-        return body + ck_bytes
-
-
-    def create_ack_bitmap(self) -> bytes:
-        bitmap = 0
-        for window_index in range(self.window_size):
-            seq_bit_i = (self.rcv_wnd_seq_num + window_index) & 0xFFFF
-            if seq_bit_i in self.received_window:
-                bitmap |= (1 << window_index)
-
-        # Calculate number of bytes needed for window_size bits
-        num_bytes = math.ceil(self.window_size / 8) # Round up to nearest byte
-        return bitmap.to_bytes(num_bytes, byteorder='big')
+        # bitmap or SACK ranges, whichever is shorter. The window is left out while all of window_size is free
+        self.advertised_window = self.get_advertised_window()
+        window = self.advertised_window if self.advertised_window < self.window_size else None
+        sack = encode_sack(self.ack_bitmap, self.seq_size, ACK_SKIPPED if self.skipped else 0, window)
+        self.skipped = False
+        return build_packet(self.seq_header, self.rcv_wnd_seq_num, sack)
 
 
     def run(self):
@@ -112,9 +216,20 @@ class wildcat_receiver(threading.Thread):
         Send with self.my_tunnel.magic_send(packet) 
         When a payload is delivered in order, call self.my_logger.commit(payload) (grading counts only committed data)'''
         while not self.die:
-            # TODO: your implementation comes here
-            pass
+            for key in self.timers.wait_expired():
+                self.timeout_callback(key)
+
+    def timeout_callback(self, key):
+        with self.lock:
+            if key == "ack" and self.unacked_packets > 0:
+                self.send_ack()
+            elif key == "skip":
+                self.skip_hole()
+            elif key == "window":
+                self.update_window()
             
     def join(self):
         self.die = True
+        self.timers.stop()
         super().join()
+        self.my_logger.close()
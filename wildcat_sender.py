@@ -1,10 +1,67 @@
+import collections
+import re
 import threading
 import struct
 import zlib
 
+import common
+import congestion
+import metrics
+from fec import fec_encoder
+from metrics import EVENTS, PACKETS, WINDOW
+
+
+class rtt_estimator:
+    ''' RFC 6298 style smoothed RTT / RTT variance, RTO derived from them with exponential backoff.
+    Without samples backoff may go up to max_rto (slow paths must be able to get one), once the RTT
+    is known it stops at backoff_factor times the estimate, but no lower than backoff_floor seconds '''
+    def __init__(self, initial_rto=0.5, min_rto=0.05, max_rto=60.0, granularity=0.001, backoff_factor=8, backoff_floor=1.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.granularity = granularity
+        self.backoff_factor = backoff_factor
+        self.backoff_floor = backoff_floor
+        self.samples = 0
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.samples += 1
+        self.reset_backoff()
+
+    def reset_backoff(self):
+        if self.srtt is not None:
+            self.rto = self.clamp(self.srtt + max(self.granularity, 4 * self.rttvar))
+
+    def backoff(self):
+        limit = self.max_rto
+        if self.srtt is not None:
+            limit = max(self.backoff_floor, self.backoff_factor * (self.srtt + max(self.granularity, 4 * self.rttvar)))
+        self.rto = self.clamp(min(self.rto * 2, max(limit, self.rto)))
+
+    def clamp(self, rto):
+        return min(self.max_rto, max(self.min_rto, rto))
+
+
+class inflight_packet:
+    def __init__(self, msg, send_time):
+        self.msg = msg
+        self.send_time = send_time
+        self.retransmitted = False
+        self.fast_retransmitted = False
+
 
 class wildcat_sender(threading.Thread):
-    def __init__(self, allowed_loss, window_size, my_tunnel, my_logger):
+    def __init__(self, allowed_loss, window_size, my_tunnel, my_logger, timers=None, max_payload_size=1024, max_queued=4096,
+                 congestion_control=None, pacing=False, pacing_gain=1.25, pacing_burst=4, dupthresh=3, my_metrics=None,
+                 seq_bits=16, fec=False, coalesce=False, coalesce_delay=0.005, max_probe_interval=1.0):
         super(wildcat_sender, self).__init__()
         self.allowed_loss = allowed_loss
         self.my_tunnel = my_tunnel
@@ -12,143 +69,555 @@ class wildcat_sender(threading.Thread):
         self.die = False
         self.window_size = window_size
 
+        # 16 bit sequence numbers cap the window at 32767 packets, 32 bit ones (same setting on the receiver) lift that
+        self.seq_size, self.seq_mask, self.seq_half = sequence_space(seq_bits)
+        self.seq_header = SEQ_HEADERS[self.seq_size]
+        if window_size >= self.seq_half:
+            raise Exception(f"window_size {window_size} too large for {seq_bits} bit sequence numbers")
+
         self.inflight_window = {}
         self.snd_wnd_seq_num = 0 # tracks seq num for sent packets
         self.rcv_wnd_seq_num = 0 # tracks acks indicating what receiver window is at
-        self.packet_queue = []
-
-
-    def new_packet(self, packet_byte_array):
+        # scoreboard, bit i <=> rcv_wnd_seq_num + i was SACKed / fast retransmitted already,
+        # so an ACK only costs work for what it newly reports instead of the whole window
+        self.sack_bitmap = 0
+        self.fast_retx_bitmap = 0
+        # flow control: the receiver advertises how many packets past its cumulative seq num its
+        # commit sink can take (at most window_size). While that is used up and nothing is in flight
+        # to bring an update, one queued packet is sent anyway as a window probe, the interval
+        # doubling up to max_probe_interval while the window stays closed
+        self.advertised_window = window_size
+        self.probe_interval = None
+        self.max_probe_interval = max_probe_interval
+        # payloads waiting for window space, producers block once max_queued are waiting
+        self.packet_queue = collections.deque()
+        self.max_queued = max_queued
+        # send_many / send_stream cut their input into payloads of at most this size
+        self.max_payload_size = max_payload_size
+        # Nagle style: small payloads are packed into one packet of up to max_payload_size as length
+        # prefixed messages (the receiver needs coalesce=True too). A message goes out right away
+        # when nothing is in flight, otherwise once the packet is full, everything in flight was
+        # acked or coalesce_delay seconds passed
+        self.coalesce = coalesce
+        self.coalesce_delay = coalesce_delay
+        self.batch = bytearray()
+
+        # one scheduler for every retransmission timer, fired from run()
+        # (or by the event loop when an async_transport scheduler is passed in)
+        self.timers = timers if timers is not None else common.timer_scheduler()
+        self.rtt = rtt_estimator()
+        self.last_backoff = 0
+        # optional congestion window on top of window_size ("newreno", "cubic" or a controller object)
+        self.cc = congestion.make_controller(congestion_control)
+        # optional token bucket pacing at pacing_gain * window / srtt, starts once there is an RTT sample
+        self.pacer = congestion.token_bucket(0, pacing_burst, self.timers.now()) if pacing else None
+        self.pacing_gain = pacing_gain
+        # a hole with this many SACKed packets above it is presumed lost and resent without waiting for its timer
+        self.dupthresh = dupthresh
+
+        self.metrics = my_metrics if my_metrics is not None else metrics.endpoint_metrics("SND")
+        self.metrics.set_gauges(self.get_gauges)
+        # optional parity packets (the receiver needs fec=True too), stands in for the tunnel
+        self.fec = None
+        if fec:
+            self.fec = self.my_tunnel = fec_encoder(my_tunnel, self.timers, self.metrics)
+        # receive() runs on the UDP thread, timeouts on this thread and new_packet() on the caller's
+        self.lock = threading.RLock()
+        self.queue_space = threading.Condition(self.lock)
+
+    def new_packet(self, packet_byte_array, block=True, timeout=None) -> bool:
         ''' invoked when user sends a payload
-        (Send with self.my_tunnel.magic_send(packet)) '''
-
-        if self.is_rcv_wnd_full():
-            print("SND: Rcv window full, queueing packet")
+        (Send with self.my_tunnel.magic_send(packet))
+        Blocks while the backlog is full (backpressure), returns False if the payload was not
+        accepted because block is False or timeout ran out. Callers on the event loop thread
+        (async_transport) must pass block=False '''
+        with self.lock:
+            if self.coalesce:
+                return self.coalesce_message(packet_byte_array, block, timeout)
+            if not self.wait_for_queue_space(block, timeout):
+                return False
+            self.send_new_packet(packet_byte_array)
+            return True
+
+    def coalesce_message(self, message, block, timeout) -> bool:
+        if len(self.batch) > 0 and len(self.batch) + MESSAGE_LENGTH.size + len(message) > self.max_payload_size:
+            if not self.wait_for_queue_space(block, timeout):
+                return False
+            self.flush_batch()
+        self.batch += MESSAGE_LENGTH.pack(len(message))
+        self.batch += message
+        self.metrics.count("messages")
+        if not self.inflight_window and not self.packet_queue:
+            self.flush_batch() # nothing to wait for
+        elif not self.timers.is_armed("coalesce"):
+            self.timers.arm("coalesce", self.coalesce_delay)
+        return True
+
+    def flush_batch(self):
+        ''' sends the messages coalesced so far as one packet '''
+        if len(self.batch) == 0:
+            return
+        self.timers.cancel("coalesce")
+        batch, self.batch = self.batch, bytearray()
+        self.send_new_packet(batch)
+
+    def send_many(self, payloads, block=True, timeout=None) -> int:
+        ''' sends every payload of an iterable, splitting any larger than max_payload_size.
+        Returns how many packets were accepted '''
+        count = 0
+        for payload in payloads:
+            for segment in self.segment(payload):
+                if not self.new_packet(segment, block, timeout):
+                    return count
+                count += 1
+        return count
+
+    def send_stream(self, stream, block=True, timeout=None) -> int:
+        ''' sends bytes-like data or a file-like object (anything with read()) as a sequence
+        of max_payload_size packets. Returns how many packets were accepted '''
+        if hasattr(stream, "read"):
+            def chunks():
+                while True:
+                    chunk = stream.read(self.max_payload_size)
+                    if not chunk:
+                        return
+                    yield chunk
+            return self.send_many(chunks(), block, timeout)
+        return self.send_many([stream], block, timeout)
+
+    def segment(self, payload):
+        if len(payload) <= self.max_payload_size:
+            return [payload]
+        view = memoryview(payload)
+        return [view[i:i + self.max_payload_size] for i in range(0, len(view), self.max_payload_size)]
+
+    def wait_until_acked(self, timeout=None) -> bool:
+        ''' blocks until everything handed to new_packet was acked, False if timeout ran out first '''
+        with self.lock:
+            if len(self.batch) > 0:
+                self.flush_batch()
+            return self.queue_space.wait_for(lambda: self.die or (not self.inflight_window and not self.packet_queue), timeout) and not self.die
+
+    def wait_for_queue_space(self, block, timeout) -> bool:
+        if len(self.packet_queue) < self.max_queued:
+            return True
+        if not block:
+            return False
+        return self.queue_space.wait_for(lambda: self.die or len(self.packet_queue) < self.max_queued, timeout) and not self.die
+
+    def send_new_packet(self, packet_byte_array):
+        if len(self.packet_queue) > 0 or not self.can_send_now():
             self.queue_pkt(packet_byte_array)
+            self.check_zero_window() # the last ACK may have closed the window with nothing left in flight
             return
-
-        # build MSG: 2B seq (uint16), payload, 2B checksum (CRC32 & OxFFFF)
-        # take curr seq (lowest 16 bits)
-        seq = self.snd_wnd_seq_num & 0xFFFF
-        # pack seq num as 2Bs (big-endian)
-        seq_bytes = struct.pack("!H", seq)
-        # ensure payload is bytes
-        payload_bytes = bytes(packet_byte_array)
-        # body used for checksum = seq + payload
-        body = seq_bytes + payload_bytes
-
-        checksum = compute_checksum(body)
-        ck_bytes = struct.pack("!H", checksum)
-
-        # final MSG = seq(2) + payload + checksum(2)
-        msg = body + ck_bytes
-        # adv seq num (wrap at 2^16)
-        self.snd_wnd_seq_num = (self.snd_wnd_seq_num + 1) & 0xFFFF
-
-        self.send_packet(msg)
-        self.print_window()
-
-    def print_window(self):
-        print(f"SND: window : {[seq_num for seq_num in self.inflight_window.keys()]}")
-
-    def send_packet(self, byte_array_with_headers):
-        print(f"SND: sending : {get_seq_num(byte_array_with_headers)}")
-        seq_num = get_seq_num(byte_array_with_headers)
+        self.transmit_new_packet(packet_byte_array)
+
+    def transmit_new_packet(self, packet_byte_array):
+        # build MSG: 2B (or 4B) seq, payload, 2B checksum (CRC32 & OxFFFF)
+        seq = self.snd_wnd_seq_num
+        msg = build_packet(self.seq_header, seq, packet_byte_array)
+        # adv seq num (wraps around)
+        self.snd_wnd_seq_num = (self.snd_wnd_seq_num + 1) & self.seq_mask
+
+        self.send_packet(seq, msg)
+        self.metrics.observe("inflight", len(self.inflight_window))
+        self.trace_window()
+
+    def trace_window(self):
+        if self.metrics.trace_level >= WINDOW:
+            self.metrics.trace(f"window : {[seq_num for seq_num in self.inflight_window.keys()]}")
+
+    def send_packet(self, seq_num, byte_array_with_headers):
+        if self.metrics.trace_level >= PACKETS:
+            self.metrics.trace(f"sending : {seq_num}")
         # actual send
         self.my_tunnel.magic_send(byte_array_with_headers)
-
-        timeout = threading.Timer(0.5, self.timeout_callback, args=(byte_array_with_headers,))
-        timeout.start()
-        self.inflight_window[seq_num] = (byte_array_with_headers, timeout)
-
-    def timeout_callback(self, byte_array_with_headers):
-        print(f"SND: timed out for : {get_seq_num(byte_array_with_headers)}, resending...")
-        self.send_packet(byte_array_with_headers)
+        self.metrics.count("sent")
+
+        self.timers.arm(seq_num, self.rtt.rto)
+        self.inflight_window[seq_num] = inflight_packet(byte_array_with_headers, self.timers.now())
+
+    def resend_packet(self, seq_num):
+        pkt = self.inflight_window[seq_num]
+        if self.metrics.trace_level >= EVENTS:
+            self.metrics.trace(f"resending : {seq_num}")
+        self.my_tunnel.magic_send(pkt.msg)
+        self.metrics.count("retransmitted")
+        # Karn's rule: acks for this seq num are ambiguous from now on, never sample them
+        pkt.retransmitted = True
+        pkt.send_time = self.timers.now()
+        self.timers.arm(seq_num, self.rtt.rto)
+
+    def fast_retransmit(self, lost):
+        for seq_num in lost:
+            # resent at most once this way, if the resend is lost too its timer takes over
+            self.inflight_window[seq_num].fast_retransmitted = True
+            self.metrics.count("fast_retransmitted")
+            self.resend_packet(seq_num)
+
+    def timeout_callback(self, seq_num):
+        with self.lock:
+            if seq_num == "pace":
+                self.process_queue()
+                return
+            if seq_num == "fec":
+                self.fec.close_block()
+                return
+            if seq_num == "coalesce":
+                self.flush_batch()
+                return
+            if seq_num == "probe":
+                self.probe_window()
+                return
+            if seq_num not in self.inflight_window:
+                return # acked while the timer was firing
+            self.metrics.count("timeouts")
+            # every packet has its own timer, only back off once per round of timeouts:
+            # packets sent before the last backoff were armed with the old RTO already
+            if self.inflight_window[seq_num].send_time >= self.last_backoff:
+                self.rtt.backoff()
+                self.last_backoff = self.timers.now()
+                if self.cc is not None:
+                    self.cc.on_timeout(self.last_backoff, self.rtt.srtt)
+            self.resend_packet(seq_num)
+
+    def ack_packet(self, seq_num):
+        ''' stop tracking an acked packet, returns its inflight entry (None if it was already acked) '''
+        self.timers.cancel(seq_num)
+        return self.inflight_window.pop(seq_num, None)
+
+    def get_rtt_stats(self) -> dict:
+        return {"srtt": self.rtt.srtt, "rttvar": self.rtt.rttvar, "rto": self.rtt.rto, "samples": self.rtt.samples}
+
+    def get_gauges(self) -> dict:
+        gauges = self.get_rtt_stats()
+        gauges["inflight"] = len(self.inflight_window)
+        gauges["queued"] = len(self.packet_queue)
+        gauges["cwnd"] = self.cc.get_cwnd() if self.cc is not None else None
+        gauges["rcv_wnd"] = self.advertised_window
+        if self.fec is not None:
+            gauges["fec_k"] = self.fec.k
+        return gauges
+
+    def get_stats(self) -> dict:
+        return self.metrics.snapshot()
 
     def receive(self, packet_byte_array):
         ''' invoked when an ACK arrives '''
-        #print(f"sender received : {packet_byte_array}")
+        with self.lock:
+            self.process_ack(packet_byte_array)
 
+    def process_ack(self, packet_byte_array):
         if not does_checksum_match(packet_byte_array):
-            print("SND: Dropping corrupted ack")
+            self.metrics.count("corrupted")
+            if self.metrics.trace_level >= EVENTS:
+                self.metrics.trace("Dropping corrupted ack")
             return
 
-        latest_rcv_seq_num = get_seq_num(packet_byte_array)
-        print(f"SND: got ack for : {latest_rcv_seq_num}")
+        latest_rcv_seq_num = get_seq_num(packet_byte_array, self.seq_size)
+        self.metrics.count("acks_received")
+        if self.metrics.trace_level >= PACKETS:
+            self.metrics.trace(f"got ack for : {latest_rcv_seq_num}")
+        # most recently sent, never retransmitted packet this ack covers, used for the RTT sample
+        newest_acked = None
+        acked_count = 0
 
         if self.did_receiver_advance_seq_num(latest_rcv_seq_num):
-            print("SND: receiver advanced seq num")
+            # new data got through, the path is alive again: like Linux, drop the backoff even
+            # if Karn's rule leaves us without a fresh sample (all acked packets were retransmits)
+            self.rtt.reset_backoff()
             # sender advanced its window, drop any inflight packet tracking outside the receiver window
+            advance = (latest_rcv_seq_num - self.rcv_wnd_seq_num) & self.seq_mask
+            self.sack_bitmap >>= advance
+            self.fast_retx_bitmap >>= advance
+            # the receiver gave up on what is still in flight below the new cumulative seq num:
+            # stop retransmitting it, but it was never delivered, so no RTT sample or window growth
+            skipped = is_skip_ack(packet_byte_array, self.seq_size)
             while self.rcv_wnd_seq_num != latest_rcv_seq_num:
-                print(f"SND: dropping packet {self.rcv_wnd_seq_num} from window")
-                timeout = self.inflight_window[self.rcv_wnd_seq_num][1]
-                timeout.cancel()
-                del self.inflight_window[self.rcv_wnd_seq_num]
-                self.rcv_wnd_seq_num = (self.rcv_wnd_seq_num + 1) & 0xFFFF
-
-        # Handle other packets whose ACKs might have been lost, but we know they were received b/c of the window_bitmap
-        rcv_window_bitmap = extract_window_bitmap(packet_byte_array)
-        for window_index in range(self.window_size):
-            if rcv_window_bitmap & (1 << window_index):
-                packet_seq_num = (latest_rcv_seq_num + window_index) & 0xFFFF
-                if packet_seq_num in self.inflight_window:
-                    timeout = self.inflight_window[packet_seq_num][1]
-                    timeout.cancel()
-                    del self.inflight_window[packet_seq_num]
-
-        self.print_window()
+                # may already be gone if an earlier ack's bitmap covered it
+                pkt = self.ack_packet(self.rcv_wnd_seq_num)
+                if pkt is not None and skipped:
+                    self.metrics.count("abandoned")
+                elif pkt is not None:
+                    acked_count += 1
+                    newest_acked = newer_sample(newest_acked, pkt)
+                self.rcv_wnd_seq_num = (self.rcv_wnd_seq_num + 1) & self.seq_mask
+
+        # Handle other packets whose ACKs might have been lost, but we know they were received b/c of the SACK ranges.
+        # A reordered, older ACK is relative to an earlier base, line it up with ours first
+        rcv_window_bitmap = extract_window_bitmap(packet_byte_array, self.seq_size)
+        rcv_window_bitmap >>= (self.rcv_wnd_seq_num - latest_rcv_seq_num) & self.seq_mask
+        for start, end in bitmap_ranges(rcv_window_bitmap & ~self.sack_bitmap):
+            for window_index in range(start, end):
+                pkt = self.ack_packet((self.rcv_wnd_seq_num + window_index) & self.seq_mask)
+                if pkt is not None:
+                    acked_count += 1
+                newest_acked = newer_sample(newest_acked, pkt)
+        self.sack_bitmap |= rcv_window_bitmap
+        lost = self.find_lost()
+        if latest_rcv_seq_num == self.rcv_wnd_seq_num:
+            # a reordered, older ACK's window is stale
+            advertised = get_advertised_window(packet_byte_array, self.seq_size)
+            self.advertised_window = self.window_size if advertised is None else min(self.window_size, advertised)
+            if not self.is_rcv_wnd_full():
+                # the window opened, a later zero window starts probing from scratch
+                self.timers.cancel("probe")
+                self.probe_interval = None
+
+        now = self.timers.now()
+        self.metrics.count("acked", acked_count)
+        if newest_acked is not None:
+            rtt_sample = now - newest_acked.send_time
+            self.rtt.sample(rtt_sample)
+            self.metrics.observe("rtt", rtt_sample, unit=1e-6)
+        if self.cc is not None and acked_count > 0:
+            self.cc.on_ack(acked_count, now, self.rtt.srtt)
+        if self.pacer is not None and self.rtt.srtt is not None:
+            self.pacer.set_rate(self.pacing_gain * self.get_send_window() / max(self.rtt.srtt, 1e-4))
+
+        if lost:
+            self.fast_retransmit(lost)
+            if self.cc is not None:
+                self.cc.on_loss(now, self.rtt.srtt)
+
+        self.trace_window()
 
         # Got an ACK, process queue to see if any more packets can be sent
         self.process_queue()
+        self.check_zero_window()
+        if not self.inflight_window:
+            self.flush_batch()
+        if not self.inflight_window:
+            self.queue_space.notify_all() # wakes wait_until_acked()
+        self.metrics.observe("queue_depth", len(self.packet_queue))
+
+    def find_lost(self) -> list:
+        ''' unSACKed packets with at least dupthresh SACKed packets above them that weren't fast
+        retransmitted yet, lowest first: every hole below the dupthresh-th highest SACK bit '''
+        if self.sack_bitmap.bit_count() < self.dupthresh:
+            return []
+        above = self.sack_bitmap
+        for _ in range(self.dupthresh - 1):
+            above ^= 1 << (above.bit_length() - 1)
+        holes = ((1 << (above.bit_length() - 1)) - 1) & ~self.sack_bitmap & ~self.fast_retx_bitmap
+        self.fast_retx_bitmap |= holes
+        lost = []
+        for start, end in bitmap_ranges(holes):
+            for window_index in range(start, end):
+                packet_seq_num = (self.rcv_wnd_seq_num + window_index) & self.seq_mask
+                if packet_seq_num in self.inflight_window:
+                    lost.append(packet_seq_num)
+        return lost
 
     def did_receiver_advance_seq_num(self, latest_rcv_seq_num):
-        distance = (latest_rcv_seq_num - self.rcv_wnd_seq_num) & 0xFFFF
-        return 0 < distance < 32768
+        distance = (latest_rcv_seq_num - self.rcv_wnd_seq_num) & self.seq_mask
+        return 0 < distance < self.seq_half
+
+    def check_zero_window(self):
+        ''' arms the window probe when the advertised window holds up the queue and no ACK is due '''
+        if self.packet_queue and not self.inflight_window and self.is_rcv_wnd_full() and not self.timers.is_armed("probe"):
+            self.probe_interval = self.rtt.rto if self.probe_interval is None else min(self.max_probe_interval, 2 * self.probe_interval)
+            self.timers.arm("probe", self.probe_interval)
+
+    def probe_window(self):
+        ''' sends the next queued packet past the advertised window: the receiver's ring still has
+        room for it and its ACK carries the current window, in case the update announcing it was lost '''
+        if not self.packet_queue or self.inflight_window or not self.is_rcv_wnd_full():
+            return
+        self.metrics.count("window_probes")
+        if self.metrics.trace_level >= EVENTS:
+            self.metrics.trace(f"probing zero window at : {self.snd_wnd_seq_num}")
+        self.transmit_new_packet(self.packet_queue.popleft())
+        self.queue_space.notify_all()
 
     def is_rcv_wnd_full(self) -> bool:
-        max_rcv_seq_num = (self.rcv_wnd_seq_num + self.window_size) & 0xFFFF
-        snd_wnd_distance = (max_rcv_seq_num - self.snd_wnd_seq_num) & 0xFFFF
+        max_rcv_seq_num = (self.rcv_wnd_seq_num + self.advertised_window) & self.seq_mask
+        snd_wnd_distance = (max_rcv_seq_num - self.snd_wnd_seq_num) & self.seq_mask
         # snd_wnd_distance > 0 => not full
-        # <32768 b/c negative distance gets converted to 65536 - distance, assume >32768(2^15) is negative => full
-        return not (0 < snd_wnd_distance < 32768)
+        # < seq_half b/c a negative distance wraps around to a huge one, assume past half the space is negative => full
+        return not (0 < snd_wnd_distance < self.seq_half)
+
+    def is_cwnd_full(self) -> bool:
+        return self.cc is not None and len(self.inflight_window) >= self.cc.get_cwnd()
+
+    def get_send_window(self) -> int:
+        if self.cc is None:
+            return self.window_size
+        return min(self.window_size, self.cc.get_cwnd())
+
+    def can_send_now(self) -> bool:
+        if self.is_rcv_wnd_full() or self.is_cwnd_full():
+            return False
+        if self.pacer is not None and self.pacer.rate > 0:
+            wait = self.pacer.consume(self.timers.now())
+            if wait > 0:
+                if not self.timers.is_armed("pace"):
+                    self.timers.arm("pace", wait)
+                return False
+        return True
 
     def queue_pkt(self, packet):
         # if next_seq > upper limit of rcv wnd (est_rcv_wnd_range), wait to send until window moves forward
         self.packet_queue.append(packet)
 
     def process_queue(self):
-        while len(self.packet_queue) > 0 and not self.is_rcv_wnd_full():
-            packet = self.packet_queue.pop(0)
-            self.new_packet(packet) #TODO: consider new_packet to only be called externally, refactor logic accordingly
+        sent = False
+        while len(self.packet_queue) > 0 and self.can_send_now():
+            packet = self.packet_queue.popleft()
+            self.transmit_new_packet(packet)
+            sent = True
+        if sent:
+            self.queue_space.notify_all()
 
     def run(self):
         ''' background loop for timers/retransmissions
         Retransmit unacked packets within 0.5 s '''
         while not self.die:
-            pass
+            for seq_num in self.timers.wait_expired():
+                self.timeout_callback(seq_num)
     
     def join(self):
-        self.die = True
+        with self.lock:
+            self.die = True
+            self.queue_space.notify_all() # release producers blocked on backpressure
+        self.timers.stop()
         super().join()
 
-def extract_window_bitmap(byte_array) -> int:
-    return int.from_bytes(get_payload(byte_array), byteorder='big')
+def unpack_messages(payload):
+    ''' the messages of a coalesced payload, as views into it '''
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(view):
+        length, = MESSAGE_LENGTH.unpack_from(view, offset)
+        offset += MESSAGE_LENGTH.size
+        yield view[offset:offset + length]
+        offset += length
+
+def newer_sample(current, pkt):
+    if pkt is None or pkt.retransmitted:
+        return current
+    if current is None or pkt.send_time > current.send_time:
+        return pkt
+    return current
+
+def sequence_space(seq_bits):
+    ''' (header bytes, wrap mask, half the space) for 16 or 32 bit sequence numbers '''
+    if seq_bits not in (16, 32):
+        raise Exception(f"Unsupported sequence number size : {seq_bits}")
+    return seq_bits // 8, (1 << seq_bits) - 1, 1 << (seq_bits - 1)
+
+SEQ_HEADERS = {2: struct.Struct("!H"), 4: struct.Struct("!I")}
+CHECKSUM = struct.Struct("!H")
+# in front of every message of a coalesced payload
+MESSAGE_LENGTH = struct.Struct("!H")
+
+# ACK body after the cumulative seq num: 1B kind, then either the bitmap of buffered packets
+# (bit i = cumulative + i, trimmed to its highest set bit) or [start, end) offset ranges
+ACK_BITMAP = 0
+ACK_RANGES = 1
+# flag on the kind byte: the cumulative seq num jumped over packets the receiver gave up on
+ACK_SKIPPED = 0x80
+# flag on the kind byte: a seq num sized advertised window follows it, the sender may only send
+# below cumulative + window. Without it the receiver has its whole window_size free
+ACK_WINDOW = 0x40
+ACK_FLAGS = ACK_SKIPPED | ACK_WINDOW
+SACK_BLOCKS = {2: struct.Struct("!HH"), 4: struct.Struct("!II")}
+# more ranges than this go as the bitmap
+MAX_SACK_RANGES = 16
+
+ONES = re.compile("1+")
+
+def bitmap_ranges(bitmap):
+    ''' [start, end) runs of set bits, lowest first. A few runs are cut out with bit tricks,
+    many in one pass over the binary digits (the bit tricks would be O(runs * bits)) '''
+    if (bitmap & ~(bitmap << 1)).bit_count() > 8:
+        # reversed so string index i is bit i
+        return [m.span() for m in ONES.finditer(format(bitmap, "b")[::-1])]
+    ranges = []
+    while bitmap:
+        start = (bitmap & -bitmap).bit_length() - 1
+        end = (~bitmap & (bitmap + (1 << start))).bit_length() - 1 # lowest clear bit above start
+        ranges.append((start, end))
+        bitmap &= ~((1 << end) - 1)
+    return ranges
+
+def encode_sack(bitmap, seq_size=2, flags=0, window=None) -> bytes:
+    ''' whichever encoding of the bitmap is shorter: few long runs (large windows with the odd
+    hole) go as ranges, scattered losses as the bitmap. window is the advertised window, if any '''
+    bitmap_bytes = (bitmap.bit_length() + 7) // 8
+    block = SACK_BLOCKS[seq_size]
+    runs = (bitmap & ~(bitmap << 1)).bit_count()
+    is_ranges = runs <= MAX_SACK_RANGES and runs * block.size < bitmap_bytes
+    body = bytearray([(ACK_RANGES if is_ranges else ACK_BITMAP) | flags | (ACK_WINDOW if window is not None else 0)])
+    if window is not None:
+        body += SEQ_HEADERS[seq_size].pack(window)
+    if is_ranges:
+        for start, end in bitmap_ranges(bitmap):
+            body += block.pack(start, end)
+        return bytes(body)
+    return bytes(body) + bitmap.to_bytes(bitmap_bytes, byteorder='big')
+
+def get_sack_body(byte_array, seq_size=2):
+    ''' (kind without flags, bitmap or ranges) of an ACK, None kind for an empty one '''
+    body = get_payload(byte_array, seq_size)
+    if len(body) == 0:
+        return None, body
+    start = 1 + seq_size if body[0] & ACK_WINDOW else 1
+    return body[0] & ~ACK_FLAGS, body[start:]
+
+def extract_sack_ranges(byte_array, seq_size=2) -> list:
+    kind, sack = get_sack_body(byte_array, seq_size)
+    if kind == ACK_RANGES:
+        return list(SACK_BLOCKS[seq_size].iter_unpack(sack))
+    return bitmap_ranges(extract_window_bitmap(byte_array, seq_size))
+
+def is_skip_ack(byte_array, seq_size=2) -> bool:
+    body = get_payload(byte_array, seq_size)
+    return len(body) > 0 and body[0] & ACK_SKIPPED != 0
+
+def get_advertised_window(byte_array, seq_size=2):
+    ''' the receiver's advertised window in packets, None if the ACK carries none (all of window_size is free) '''
+    body = get_payload(byte_array, seq_size)
+    if len(body) < 1 + seq_size or not body[0] & ACK_WINDOW:
+        return None
+    return SEQ_HEADERS[seq_size].unpack_from(body, 1)[0]
+
+def extract_window_bitmap(byte_array, seq_size=2) -> int:
+    kind, sack = get_sack_body(byte_array, seq_size)
+    if kind is None:
+        return 0
+    if kind == ACK_BITMAP:
+        return int.from_bytes(sack, byteorder='big')
+    bitmap = 0
+    for start, end in SACK_BLOCKS[seq_size].iter_unpack(sack):
+        bitmap |= ((1 << (end - start)) - 1) << start
+    return bitmap
+
+def build_packet(seq_header, seq, body) -> bytearray:
+    ''' seq num + body + checksum, laid out in one buffer: body is copied once, the checksum is taken over a view '''
+    packet = bytearray(seq_header.size + len(body) + CHECKSUM.size)
+    seq_header.pack_into(packet, 0, seq)
+    packet[seq_header.size:-CHECKSUM.size] = body
+    CHECKSUM.pack_into(packet, len(packet) - CHECKSUM.size, compute_checksum(memoryview(packet)[:-CHECKSUM.size]))
+    return packet
 
 def compute_checksum(byte_array) -> int:
     # keep lower 16 bits to fit in 2 byte checksum header
     return zlib.crc32(byte_array) & 0xFFFF
 
 def does_checksum_match(byte_array) -> bool:
-    return get_ck_sum(byte_array) == compute_checksum(get_seq_num_and_payload(byte_array))
+    # over a view, slicing would copy the packet
+    view = memoryview(byte_array)
+    return len(view) >= CHECKSUM.size and get_ck_sum(view) == compute_checksum(view[:-CHECKSUM.size])
 
-def get_seq_num(byte_array) -> int:
-    return struct.unpack("!H", byte_array[:2])[0]
+def get_seq_num(byte_array, seq_size=2) -> int:
+    return int.from_bytes(byte_array[:seq_size], byteorder='big')
 
 def get_ck_sum(byte_array) -> int:
-    return struct.unpack("!H", byte_array[-2:])[0]
+    return CHECKSUM.unpack_from(byte_array, len(byte_array) - CHECKSUM.size)[0]
 
-def get_payload(byte_array) -> bytes:
-    return byte_array[2:-2]
+def get_payload(byte_array, seq_size=2) -> bytes:
+    return byte_array[seq_size:-2]
 
 def get_seq_num_and_payload(byte_array) -> bytes:
     return byte_array[0:-2]
\ No newline at end of file
@@ -0,0 +1,133 @@
+''' Multi-process receiver.
+N forked workers bind the same port with SO_REUSEPORT and the kernel hashes every sender
+(by source address) to one of them, so checksums, window processing and logging run on N
+cores instead of under one GIL. Each worker is a multiplex.udp_multiplexer with its own commit
+log shard ("<log file>.worker<i>", 4B connection id + payload records, like the multiplexer's
+log), so senders must use --multiplex framing. The parent only supervises the workers and
+aggregates the metrics they report. Example:
+
+    pool = worker_pool(4, 8000, allowed_loss, window_size, loss_rate, corrupt_rate)
+    pool.start()
+    while serving:
+        pool.poll(1.0)
+    pool.stop()
+'''
+
+import multiprocessing
+import queue
+import signal
+import socket
+import time
+
+import common
+import metrics
+import multiplex
+
+
+def pick_port(port) -> int:
+    ''' port 0 can't be handed to N processes, they would each get their own. Resolve it once here '''
+    if port != 0:
+        return port
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    probe.bind(('', 0))
+    port = probe.getsockname()[1]
+    probe.close() # an open socket nobody reads would get its share of the flows
+    return port
+
+
+def worker_state(mux) -> dict:
+    state = mux.metrics.export()
+    flow_state = mux.flow_metrics.export()
+    state["counters"].update(flow_state["counters"])
+    state["histograms"].update(flow_state["histograms"])
+    state["gauges"] = {"flows": len(mux.flows)}
+    return state
+
+
+def run_worker(index, port, allowed_loss, window_size, loss_rate, corrupt_rate, shard_file, log_format, fsync_policy,
+               receiver_options, mux_options, stats_interval, stats_queue, stop_event):
+    # Ctrl-C reaches the whole process group, only the parent decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    my_tunnel = common.magic_tunnel(loss_rate, corrupt_rate)
+    my_logger = common.logger(shard_file, log_format=log_format, fsync_policy=fsync_policy, keep_commits=False)
+    mux = multiplex.udp_multiplexer(my_tunnel, port, allowed_loss, window_size, my_logger=my_logger,
+                                    receiver_options=receiver_options, reuse_port=True, **mux_options)
+    mux.start()
+    try:
+        while not stop_event.wait(stats_interval):
+            stats_queue.put((index, worker_state(mux)))
+    finally:
+        mux.join()
+        my_logger.close()
+        my_tunnel.close()
+        stats_queue.put((index, worker_state(mux)))
+
+
+class worker_pool:
+    ''' forks and supervises the workers. poll() collects their reports and notices workers that died,
+    the kernel hands a dead worker's share of new flows to the survivors '''
+    def __init__(self, workers, port, allowed_loss, window_size, loss_rate, corrupt_rate, log_file=common.log_file,
+                 log_format="text", fsync_policy="never", receiver_options=None, stats_interval=1.0, **mux_options):
+        self.port = pick_port(port)
+        self.log_file = log_file
+        # fork: the parent has no threads yet and workers start without re-importing anything
+        self.context = multiprocessing.get_context("fork")
+        self.stats_queue = self.context.Queue()
+        self.stop_event = self.context.Event()
+        self.worker_args = (self.port, allowed_loss, window_size, loss_rate, corrupt_rate)
+        self.log_options = (log_format, fsync_policy)
+        self.receiver_options = receiver_options or {}
+        self.mux_options = mux_options
+        self.stats_interval = stats_interval
+        self.processes = [None] * workers
+        self.states = {}
+        self.dead = set()
+        self.stopping = False
+
+    def shard_file(self, index) -> str:
+        return f"{self.log_file}.worker{index}"
+
+    def start(self):
+        for index in range(len(self.processes)):
+            self.processes[index] = self.context.Process(
+                target=run_worker, daemon=True,
+                args=(index, *self.worker_args, self.shard_file(index), *self.log_options, self.receiver_options,
+                      self.mux_options, self.stats_interval, self.stats_queue, self.stop_event))
+            self.processes[index].start()
+
+    def poll(self, timeout=0):
+        ''' waits up to timeout for worker reports and keeps the latest one of each worker '''
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                index, state = self.stats_queue.get(timeout=max(0, deadline - time.monotonic()))
+                self.states[index] = state
+            except queue.Empty:
+                break
+        for index, process in enumerate(self.processes):
+            if not self.stopping and index not in self.dead and not process.is_alive():
+                self.dead.add(index)
+                print(f"RCVR: worker {index} exited with {process.exitcode}")
+
+    def aggregate(self) -> metrics.endpoint_metrics:
+        total = metrics.endpoint_metrics("RCVR")
+        for state in self.states.values():
+            total.merge(state)
+        flows = sum(state["gauges"]["flows"] for state in self.states.values())
+        workers = sum(1 for process in self.processes if process.is_alive())
+        total.set_gauges(lambda: {"flows": flows, "workers": workers})
+        return total
+
+    def stop(self, timeout=10):
+        self.stopping = True
+        self.stop_event.set()
+        deadline = time.monotonic() + timeout
+        # keep draining while they exit, a worker blocks on exit until its last report was read
+        while any(process.is_alive() for process in self.processes) and time.monotonic() < deadline:
+            self.poll(0.05)
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self.poll()